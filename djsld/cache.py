@@ -0,0 +1,616 @@
+"""
+Cache class breaks in the django cache framework.
+
+Computing class breaks requires a query over the entire data distribution,
+and may require an expensive classification. When caching is enabled, the
+breaks are stored in a django cache, keyed on the SQL of the queryset, the
+field, the classifier, the number of classes and the classifier options.
+
+Each model that contributes to a cached classification has a generation
+token in the cache, which is part of every cache key. The models of a
+classification are the model of the queryset, the models of the tables that
+the queryset joins, such as those its filters traverse, and the models that
+the classified field traverses. Saving or deleting an instance of a
+registered model replaces its token, so all the class breaks that depend on
+that model are recomputed on their next use. Models are registered
+automatically when they are first used in a cached classification, but in a
+multi-process deployment every process should register its models at
+startup:
+
+    from djsld import cache
+    cache.register(MySpatialModel)
+
+This invalidation is best-effort. Changes that send no signals, such as
+C{QuerySet.update()}, C{bulk_create()} and raw SQL, and changes to the
+models of subqueries, are not noticed, and must be followed by a call to
+L{invalidate}, unless C{DJSLD_CACHE_FINGERPRINT} is set (see below).
+
+The cache used is configured with the C{DJSLD_CACHE} setting, which names a
+cache in C{CACHES} and defaults to 'default'. Cache entries expire after
+C{DJSLD_CACHE_TIMEOUT} seconds, which defaults to the timeout of the cache.
+
+When the class breaks are missing, only one thread in each process, and one
+process at a time, computes them. Threads of the same process wait for the
+thread computing the same breaks, and processes take a lock in the cache
+itself, with C{cache.add}. While
+the breaks are being computed, the others are served the last class breaks
+computed for the same classification, if there are any, or wait until the
+new breaks are stored. A thread or process waits for at most
+C{DJSLD_CACHE_LOCK_TIMEOUT} seconds, which defaults to 30, before computing
+the breaks itself. Set C{DJSLD_CACHE_SERVE_STALE} to False to always wait
+for the new breaks.
+
+With the C{DJSLD_CACHE_FINGERPRINT} setting, the key also includes a
+L{get_fingerprint} of the data, which is computed with one aggregate query
+for each request, and the class breaks never expire. They are recomputed
+only when the data changes.
+
+With the C{DJSLD_CACHE_BACKGROUND} setting, stale class breaks are served
+at once even when no one is computing new breaks, and the new breaks are
+computed by a pool of C{DJSLD_CACHE_WORKERS} background threads, which
+defaults to 2. At most C{DJSLD_CACHE_QUEUE_SIZE} computations, which
+defaults to 100, wait for a thread; further ones are left for later
+requests. The age of the class breaks served to a thread is available from
+L{last_age}.
+
+When the breaks are read from a replica, with the C{DJSLD_DATABASE}
+setting, breaks recomputed just after an invalidation may be read before
+the replica has the change. Set C{DJSLD_CACHE_REPLICA_LAG} to the longest
+lag of the replica, in seconds: breaks computed within that time of an
+invalidation expire when it has passed, and are then computed again.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+import hashlib, logging, math, threading, time, uuid
+try:
+    from Queue import Queue, Full
+except ImportError:
+    # python 3
+    from queue import Queue, Full
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.signals import post_save, post_delete
+try:
+    from django.apps import apps
+    get_models = apps.get_models
+except ImportError:
+    # django < 1.7
+    from django.db.models import get_models
+from djsld.classifiers import Breaks
+
+FOREVER = None
+"""A timeout for cache entries that should not expire."""
+
+DEFAULT = object()
+"""A marker for cache entries stored with the default timeout of the cache."""
+
+LOCK_POLL_INTERVAL = 0.1
+"""The number of seconds between checks for class breaks computed by another process."""
+
+_lock = threading.Lock()
+_flights = {}
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'stale': 0, 'waits': 0}
+_served = threading.local()
+_queue = None
+_pending = set()
+_workers = None
+
+logger = logging.getLogger(__name__)
+_registered = set()
+
+def get_backend():
+    """
+    Get the django cache that stores class breaks.
+
+    @returns: The cache named by the C{DJSLD_CACHE} setting.
+    """
+    alias = getattr(settings, 'DJSLD_CACHE', 'default')
+    try:
+        from django.core.cache import caches
+        return caches[alias]
+    except ImportError:
+        # django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+
+def get_or_classify(classname, queryset, field, nclasses, classify, options=None, 
+    background=None, fingerprint=None, **kwargs):
+    """
+    Get class breaks from the cache, or compute and cache them.
+
+    @type  classname: string
+    @param classname: The name of the classifier.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type  classify: callable
+    @param classify: A function of no arguments that computes the class breaks.
+    @type    options: dict
+    @keyword options: Other options that change the class breaks, such as sampling.
+    @type    background: boolean
+    @keyword background: Should stale class breaks be served at once, while new breaks are computed in the background? Defaults to the C{DJSLD_CACHE_BACKGROUND} setting.
+    @type    fingerprint: boolean
+    @keyword fingerprint: Should the class breaks be kept until the L{get_fingerprint} of the queryset changes, instead of expiring? Defaults to the C{DJSLD_CACHE_FINGERPRINT} setting.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks.
+    """
+    backend = get_backend()
+    models, key, stalekey, expires = _keys(classname, queryset, field, nclasses, options, 
+        fingerprint, kwargs)
+
+    breaks = backend.get(key)
+    if not breaks is None:
+        _count('hits')
+        return _serve(breaks)
+
+    expires = _lag_timeout(backend, models, expires)
+    servestale = getattr(settings, 'DJSLD_CACHE_SERVE_STALE', True)
+    if background is None:
+        background = getattr(settings, 'DJSLD_CACHE_BACKGROUND', False)
+
+    # serve the stale breaks at once, and compute the new breaks later
+    if background:
+        stale = backend.get(stalekey)
+        if not stale is None:
+            _count('stale')
+            _schedule(key, stalekey, classify, expires)
+            return _serve(stale)
+
+    # one thread per process and key: the others are served the stale
+    # breaks, or wait for the breaks computed by the first
+    timeout = getattr(settings, 'DJSLD_CACHE_LOCK_TIMEOUT', 30)
+    with _lock:
+        flight = _flights.get(key)
+        first = flight is None
+        if first:
+            flight = _flights[key] = threading.Event()
+
+    if not first:
+        stale = backend.get(stalekey) if servestale else None
+        if not stale is None:
+            _count('stale')
+            return _serve(stale)
+
+        _count('waits')
+        flight.wait(timeout)
+
+    try:
+        breaks = backend.get(key)
+        if not breaks is None:
+            _count('hits')
+            return _serve(breaks)
+
+        if not first and not flight.is_set():
+            # the first thread did not finish in time
+            return _serve(_store(backend, key, stalekey, classify, expires))
+
+        # one process at a time
+        lockkey = '%s:lock' % key
+        token = _new_generation()
+        if not backend.add(lockkey, token, timeout):
+            stale = backend.get(stalekey) if servestale else None
+            if not stale is None:
+                _count('stale')
+                return _serve(stale)
+
+            _count('waits')
+            breaks = _wait(backend, key, lockkey, timeout)
+            if not breaks is None:
+                _count('hits')
+                return _serve(breaks)
+
+            # the other process did not finish in time
+            backend.add(lockkey, token, timeout)
+
+        try:
+            breaks = _store(backend, key, stalekey, classify, expires)
+        finally:
+            if backend.get(lockkey) == token:
+                backend.delete(lockkey)
+    finally:
+        if first:
+            with _lock:
+                del _flights[key]
+            flight.set()
+
+    return _serve(breaks)
+
+def get(classname, queryset, field, nclasses, options=None, fingerprint=None, **kwargs):
+    """
+    Get class breaks from the cache, without computing them if they are
+    missing. The arguments are those of L{get_or_classify}.
+
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they are not cached.
+    """
+    models, key, stalekey, expires = _keys(classname, queryset, field, nclasses, options, 
+        fingerprint, kwargs)
+
+    breaks = get_backend().get(key)
+    if breaks is None:
+        return None
+
+    _count('hits')
+    return _serve(breaks)
+
+def last_age():
+    """
+    Get the age of the class breaks served last to this thread by
+    L{get_or_classify}, such as for an HTTP C{Age} header.
+
+    @rtype: float
+    @returns: The number of seconds since the class breaks were computed, or
+        None if no class breaks were served.
+    """
+    return getattr(_served, 'age', None)
+
+def make_key(classname, queryset, field, nclasses, models, options=None, **kwargs):
+    """
+    Build the cache key for a classification.
+
+    @type  classname: string
+    @param classname: The name of the classifier.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type    models: list
+    @param   models: The models whose generation tokens are part of the key.
+    @type    options: dict
+    @keyword options: Other options that change the class breaks, such as sampling.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @rtype: string
+    @returns: A cache key.
+    """
+    generations = [_generation(model) for model in models]
+    return 'djsld:breaks:%s' % _digest(classname, queryset, field, nclasses, generations, 
+        options, kwargs)
+
+def get_fingerprint(queryset, field):
+    """
+    Summarize the data of a classification in one aggregate query: the number
+    of values, their sum, minimum and maximum, the largest primary key, and
+    the latest modification time, if the model has a date field with
+    C{auto_now}. Most changes to the data change the fingerprint, including
+    bulk updates and changes made outside of django, which send no signals.
+    A change that keeps the count, sum and range of the values, such as
+    swapping two values, is only detected through the modification time.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @rtype: tuple
+    @returns: The summary of the data.
+    """
+    aggregates = {
+        'n': Count(field),
+        'sum': Sum(field),
+        'lo': Min(field),
+        'hi': Max(field),
+        'pk': Max('pk')
+    }
+    for f in queryset.model._meta.fields:
+        if getattr(f, 'auto_now', False):
+            aggregates['updated_%s' % f.name] = Max(f.name)
+
+    summary = queryset.order_by().aggregate(**aggregates)
+    return tuple(sorted((name, repr(value)) for name, value in summary.items()))
+
+def register(*models):
+    """
+    Invalidate the class breaks computed from a model whenever an instance
+    of the model is saved or deleted.
+
+    @type  models: django models
+    @param models: The model classes to watch.
+    """
+    for model in models:
+        label = _label(model)
+        if label in _registered:
+            continue
+
+        uid = 'djsld.cache.%s' % label
+        post_save.connect(_invalidate_sender, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(_invalidate_sender, sender=model, weak=False, dispatch_uid=uid)
+        _registered.add(label)
+
+def invalidate(model):
+    """
+    Invalidate all the cached class breaks that were computed from a model.
+
+    @type  model: django model
+    @param model: The model class that changed.
+    """
+    _count('invalidations')
+    backend = get_backend()
+    backend.set(_generation_key(model), _new_generation(), FOREVER)
+    backend.set(_invalidated_key(model), time.time(), FOREVER)
+
+def stats():
+    """
+    Get the hit, miss, and invalidation counters of this process.
+
+    @rtype: dict
+    @returns: The values of the 'hits', 'misses' and 'invalidations' counters,
+        the 'stale' counter of stale class breaks served while new breaks were
+        computed, and the 'waits' counter of waits for new breaks.
+    """
+    with _lock:
+        return dict(_stats)
+
+def reset_stats():
+    """
+    Reset the statistics counters of this process to zero.
+    """
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
+
+def _invalidate_sender(sender, **kwargs):
+    """
+    A signal receiver that invalidates the class breaks of the sender model.
+    """
+    invalidate(sender)
+
+def _count(name):
+    """
+    Increment a statistics counter.
+    """
+    with _lock:
+        _stats[name] += 1
+
+def _digest(classname, queryset, field, nclasses, generations, options, kwargs):
+    """
+    Hash everything that identifies a classification.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    ident = repr((queryset.db, sql, tuple(params), field, classname, nclasses, 
+        sorted(kwargs.items()), sorted((options or {}).items()), generations))
+    return hashlib.md5(ident.encode('utf-8')).hexdigest()
+
+def _keys(classname, queryset, field, nclasses, options, fingerprint, kwargs):
+    """
+    Get the models of a classification, the cache keys of its current and
+    stale class breaks, and the timeout of its current class breaks.
+    """
+    models = _related_models(queryset, field)
+    register(*models)
+
+    stalekey = 'djsld:stale:%s' % _digest(classname, queryset, field, nclasses, None, options, kwargs)
+
+    if fingerprint is None:
+        fingerprint = getattr(settings, 'DJSLD_CACHE_FINGERPRINT', False)
+    if fingerprint:
+        # a change in the data changes the key, so the breaks never expire
+        options = dict(options or {}, fingerprint=get_fingerprint(queryset, field))
+        expires = FOREVER
+    else:
+        expires = getattr(settings, 'DJSLD_CACHE_TIMEOUT', DEFAULT)
+
+    key = make_key(classname, queryset, field, nclasses, models, options=options, **kwargs)
+    return models, key, stalekey, expires
+
+def _serve(breaks):
+    """
+    Record the age of the class breaks served to this thread.
+    """
+    created = getattr(breaks, 'created', None)
+    _served.age = None if created is None else max(0., time.time() - created)
+    return breaks
+
+def _store(backend, key, stalekey, classify, expires=DEFAULT):
+    """
+    Compute class breaks, and store them as both the current and the stale
+    class breaks.
+    """
+    _count('misses')
+    q = classify()
+    breaks = Breaks(q.bins, getattr(q, 'error', None))
+    breaks.created = time.time()
+    if expires is DEFAULT:
+        backend.set(key, breaks)
+    else:
+        backend.set(key, breaks, expires)
+    backend.set(stalekey, breaks, FOREVER)
+
+    return breaks
+
+def _schedule(key, stalekey, classify, expires=DEFAULT):
+    """
+    Queue the computation of new class breaks in the background, unless they
+    are already queued. If the queue is full, the breaks are computed by a
+    later request.
+    """
+    global _queue, _workers
+
+    with _lock:
+        if key in _pending:
+            return
+        if _workers is None:
+            _queue = Queue(getattr(settings, 'DJSLD_CACHE_QUEUE_SIZE', 100))
+            workers = getattr(settings, 'DJSLD_CACHE_WORKERS', 2)
+            _workers = [threading.Thread(target=_work, name='djsld-cache-%d' % i) for i in range(workers)]
+            for worker in _workers:
+                worker.daemon = True
+                worker.start()
+
+        try:
+            _queue.put_nowait((key, stalekey, classify, expires,))
+        except Full:
+            logger.warning('The djsld cache refresh queue is full.')
+            return
+        _pending.add(key)
+
+def _work():
+    """
+    Compute the queued class breaks, forever.
+    """
+    while True:
+        key, stalekey, classify, expires = _queue.get()
+        try:
+            _refresh(key, stalekey, classify, expires)
+        except Exception:
+            logger.exception('Could not refresh the cached class breaks.')
+        finally:
+            with _lock:
+                _pending.discard(key)
+
+            # connections are per thread, and this thread lives forever
+            for connection in connections.all():
+                connection.close()
+
+def _refresh(key, stalekey, classify, expires=DEFAULT):
+    """
+    Compute and store new class breaks, unless another process is already
+    computing them.
+    """
+    backend = get_backend()
+    if not backend.get(key) is None:
+        return
+
+    lockkey = '%s:lock' % key
+    token = _new_generation()
+    if not backend.add(lockkey, token, getattr(settings, 'DJSLD_CACHE_LOCK_TIMEOUT', 30)):
+        return
+
+    try:
+        _store(backend, key, stalekey, classify, expires)
+    finally:
+        if backend.get(lockkey) == token:
+            backend.delete(lockkey)
+
+def _wait(backend, key, lockkey, timeout):
+    """
+    Wait for another process to store class breaks, until it releases its
+    lock, or the timeout expires.
+
+    @returns: The class breaks, or None if they were not stored in time.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        breaks = backend.get(key)
+        if not breaks is None:
+            return breaks
+        if backend.get(lockkey) is None:
+            # the other process failed
+            return backend.get(key)
+
+    return None
+
+def _label(model):
+    """
+    Get a unique name for a model.
+    """
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def _generation_key(model):
+    """
+    Get the cache key of the generation token of a model.
+    """
+    return 'djsld:generation:%s' % _label(model)
+
+def _invalidated_key(model):
+    """
+    Get the cache key of the time a model was last invalidated.
+    """
+    return 'djsld:invalidated:%s' % _label(model)
+
+def _lag_timeout(backend, models, expires):
+    """
+    Shorten the timeout of class breaks computed less than
+    C{DJSLD_CACHE_REPLICA_LAG} seconds after one of their models was
+    invalidated, since they may have been read from a replica that did not
+    have the change yet. They are then recomputed once the replica has it.
+    """
+    lag = getattr(settings, 'DJSLD_CACHE_REPLICA_LAG', 0)
+    if not lag:
+        return expires
+
+    invalidated = backend.get_many([_invalidated_key(model) for model in models]).values()
+    if len(invalidated) == 0:
+        return expires
+
+    remaining = int(math.ceil(max(invalidated) + lag - time.time()))
+    if remaining <= 0:
+        return expires
+    if expires is DEFAULT or expires is None or expires > remaining:
+        return remaining
+    return expires
+
+def _new_generation():
+    """
+    Create a new generation token.
+    """
+    return uuid.uuid4().hex
+
+def _generation(model):
+    """
+    Get the generation token of a model, creating it if it does not exist.
+    A token that has been evicted is replaced with a new one, so stale class
+    breaks are never matched by a recreated token.
+    """
+    backend = get_backend()
+    key = _generation_key(model)
+
+    generation = backend.get(key)
+    if generation is None:
+        backend.add(key, _new_generation(), FOREVER)
+        generation = backend.get(key)
+
+    return generation
+
+def _related_models(queryset, field):
+    """
+    Get the model of a queryset, all the models traversed by the related
+    field lookup of the classified field, and the models of the other tables
+    that the queryset joins. The tables of subqueries are not found.
+    """
+    model = queryset.model
+    models = [model]
+    for name in field.split('__')[:-1]:
+        related, owner, direct, m2m = model._meta.get_field_by_name(name)
+        if direct:
+            model = related.rel.to
+        else:
+            model = related.model
+        models.append(model)
+
+    tables = dict((m._meta.db_table, m,) for m in get_models())
+    for join in queryset.query.alias_map.values():
+        model = tables.get(join.table_name)
+        if not model is None and not model in models:
+            models.append(model)
+
+    return models
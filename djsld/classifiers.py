@@ -0,0 +1,772 @@
+"""
+Classification results and classifiers that do not depend on pysal.
+
+The pysal classifiers used by L{djsld.generator} return objects with C{bins}
+and C{k} attributes. Class breaks computed by djsld itself are returned as
+L{Breaks} objects, which expose the same attributes, so the generator can
+render either kind of result.
+
+The classifiers in this module are NumPy implementations of the pysal
+classifiers of the same name. They are selected in the generator with the
+C{backend='numpy'} keyword. L{Fisher_Jenks} produces exactly the same breaks
+as pysal, using O(k*n) memory instead of pysal's python lists, and vectorized
+arithmetic instead of pysal's inner python loops. L{Equal_Interval},
+L{Quantiles} and L{Maximum_Breaks} also produce the same breaks as pysal,
+without pysal's summary statistics of each class. The values fetched by the
+generator are already sorted, and the classifiers do not sort them again.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+from numpy import arange, array, asarray, concatenate, cumsum, float64, intp, median, \
+    minimum, ones, random, repeat, searchsorted, sort, unique, zeros
+
+class Breaks(object):
+    """
+    The upper bounds of each class in a classification.
+    """
+
+    def __init__(self, bins, error=None, gvf=None):
+        """
+        Create a set of class breaks.
+
+        @type  bins: sequence
+        @param bins: The upper bound of each class, in ascending order. The
+            type of each value is kept, so that the breaks are rendered the
+            same way as the breaks of the corresponding pysal classifier.
+        @type  error: float
+        @param error: The largest error of each break, if the breaks are approximate.
+        @type  gvf: float
+        @param gvf: The goodness of variance fit of the classes, if known.
+        """
+        self.bins = bins
+        """The upper bound of each class."""
+
+        self.error = error
+        """The largest error of each break, or None if the breaks are exact."""
+
+        self.gvf = gvf
+        """The goodness of variance fit of the classes, or None if unknown."""
+
+        self.created = None
+        """The time the breaks were computed, if they were cached."""
+
+        self.k = len(self.bins)
+        """The number of classes."""
+
+class Equal_Interval(Breaks):
+    """
+    Equal Interval classifier, equivalent to
+    C{pysal.esda.mapclassify.Equal_Interval}.
+    """
+
+    def __init__(self, y, k=5):
+        """
+        Classify a distribution of values.
+
+        @type  y: numpy.ndarray
+        @param y: The values to classify.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Equal_Interval, self).__init__(equal_interval(y, k))
+
+class Fisher_Jenks(Breaks):
+    """
+    Fisher Jenks optimal classifier, equivalent to
+    C{pysal.esda.mapclassify.Fisher_Jenks}.
+    """
+
+    def __init__(self, y, k=5):
+        """
+        Classify a distribution of values.
+
+        @type  y: numpy.ndarray
+        @param y: The values to classify.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Fisher_Jenks, self).__init__(fisher_jenks(y, k))
+
+class Maximum_Breaks(Breaks):
+    """
+    Maximum Breaks classifier, equivalent to
+    C{pysal.esda.mapclassify.Maximum_Breaks}.
+    """
+
+    def __init__(self, y, k=5, mindiff=0):
+        """
+        Classify a distribution of values.
+
+        @type  y: numpy.ndarray
+        @param y: The values to classify.
+        @type  k: integer
+        @param k: The number of classes required.
+        @type  mindiff: number
+        @param mindiff: The smallest difference between values that may be a break.
+        """
+        super(Maximum_Breaks, self).__init__(maximum_breaks(y, k, mindiff))
+
+class Natural_Breaks(Breaks):
+    """
+    Natural Breaks classifier, equivalent to
+    C{pysal.esda.mapclassify.Natural_Breaks}.
+    """
+
+    def __init__(self, y, k=5, initial=100):
+        """
+        Classify a distribution of values.
+
+        @type  y: numpy.ndarray
+        @param y: The values to classify.
+        @type  k: integer
+        @param k: The number of classes required.
+        @type  initial: integer
+        @param initial: The number of additional random initial solutions to try.
+        """
+        super(Natural_Breaks, self).__init__(natural_breaks(y, k, initial))
+
+class Quantiles(Breaks):
+    """
+    Quantile classifier, equivalent to C{pysal.esda.mapclassify.Quantiles}.
+    """
+
+    def __init__(self, y, k=4):
+        """
+        Classify a distribution of values.
+
+        @type  y: numpy.ndarray
+        @param y: The values to classify.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Quantiles, self).__init__(quantiles(y, k))
+
+class Weighted_Quantiles(Breaks):
+    """
+    Quantile classifier of weighted values, equivalent to
+    C{pysal.esda.mapclassify.Quantiles} of the values repeated by their weights.
+    """
+
+    def __init__(self, y, weights, k=4):
+        """
+        Classify a distribution of weighted values.
+
+        @type  y: numpy.ndarray
+        @param y: The sorted distinct values to classify.
+        @type  weights: numpy.ndarray
+        @param weights: The integer weight of each value.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Weighted_Quantiles, self).__init__(weighted_quantiles(y, weights, k))
+
+class Weighted_Fisher_Jenks(Breaks):
+    """
+    Fisher Jenks optimal classifier of weighted values.
+    """
+
+    def __init__(self, y, weights, k=5):
+        """
+        Classify a distribution of weighted values.
+
+        @type  y: numpy.ndarray
+        @param y: The sorted distinct values to classify.
+        @type  weights: numpy.ndarray
+        @param weights: The weight of each value.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Weighted_Fisher_Jenks, self).__init__(weighted_fisher_jenks(y, weights, k))
+
+class Weighted_Jenks_Caspall(Breaks):
+    """
+    Jenks Caspall classifier of weighted values.
+    """
+
+    def __init__(self, y, weights, k=5):
+        """
+        Classify a distribution of weighted values.
+
+        @type  y: numpy.ndarray
+        @param y: The sorted distinct values to classify.
+        @type  weights: numpy.ndarray
+        @param weights: The weight of each value.
+        @type  k: integer
+        @param k: The number of classes required.
+        """
+        super(Weighted_Jenks_Caspall, self).__init__(weighted_jenks_caspall(y, weights, k))
+
+CLASSIFIERS = {
+    'Equal_Interval': Equal_Interval,
+    'Fisher_Jenks': Fisher_Jenks,
+    'Maximum_Breaks': Maximum_Breaks,
+    'Natural_Breaks': Natural_Breaks,
+    'Quantiles': Quantiles,
+}
+"""The NumPy classifiers, by pysal class name."""
+
+WEIGHTED_CLASSIFIERS = {
+    'Quantiles': Weighted_Quantiles,
+}
+"""The classifiers of weighted values that produce the same breaks as the
+pysal classifier of the expanded distribution, by pysal class name."""
+
+OPTIMAL_CLASSIFIERS = {
+    'Fisher_Jenks': Weighted_Fisher_Jenks,
+}
+"""The classifiers of weighted values that find classes as good as the
+optimal classes of the pysal classifier of the expanded distribution, by
+pysal class name. Of several equally good classifications, they may choose
+a different one than pysal."""
+
+APPROXIMATE_CLASSIFIERS = {
+    'Jenks_Caspall': Weighted_Jenks_Caspall,
+}
+"""The classifiers of weighted values that minimize the same criteria as the
+pysal classifier, without expanding the distribution, by pysal class name."""
+
+DISTINCT_CLASSIFIERS = ('Equal_Interval', 'Maximum_Breaks',)
+"""The pysal classifiers that compute the same breaks from the distinct values
+of a distribution as from the entire distribution."""
+
+def classify_weighted(classification, y, weights, k, exact=True, **kwargs):
+    """
+    Classify a distribution given as distinct values and the number of times
+    each value occurs. Classifiers that do not depend on repeated values are
+    given only the distinct values, classifiers with a weighted implementation
+    use it, and all other classifiers are given the expanded distribution.
+    Fisher Jenks classes are as good as those of the expanded distribution,
+    but where several classifications are equally good, the breaks may be
+    different.
+
+    @type  classification: classifier
+    @param classification: A classification class from pysal, or from this module.
+    @type  y: numpy.ndarray
+    @param y: The sorted distinct values to classify.
+    @type  weights: numpy.ndarray
+    @param weights: The integer weight of each value.
+    @type  k: integer
+    @param k: The number of classes required.
+    @type  exact: boolean
+    @param exact: Must the breaks be the same as the breaks of the expanded
+        distribution? If not, the classifiers in L{APPROXIMATE_CLASSIFIERS}
+        are used instead of expanding the distribution.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @returns: An object with C{bins} and C{k} attributes.
+    """
+    name = classification.__name__
+    if name in WEIGHTED_CLASSIFIERS:
+        return WEIGHTED_CLASSIFIERS[name](y, weights, k, **kwargs)
+
+    if name in OPTIMAL_CLASSIFIERS:
+        return OPTIMAL_CLASSIFIERS[name](y, weights, k, **kwargs)
+
+    if not exact and name in APPROXIMATE_CLASSIFIERS:
+        return APPROXIMATE_CLASSIFIERS[name](y, weights, k, **kwargs)
+
+    # zero differences between repeated values are not breaks, unless
+    # mindiff is negative
+    if name in DISTINCT_CLASSIFIERS and kwargs.get('mindiff', 0) >= 0:
+        return classification(y, k, **kwargs)
+
+    return classification(repeat(y, weights), k, **kwargs)
+
+def equal_interval(y, k=5):
+    """
+    Compute Equal Interval breaks, which divide the range of the values into
+    k classes of equal width.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  k: integer
+    @param k: The number of classes required.
+    @rtype: numpy.ndarray
+    @returns: The upper bound of each class.
+    """
+    values = _sorted(y)
+    min_y = values[0]
+    max_y = values[-1]
+
+    # this mirrors pysal.esda.mapclassify.Equal_Interval
+    width = (max_y - min_y) * 1. / k
+    cuts = arange(min_y + width, max_y + width, width)
+    if len(cuts) > k:
+        cuts = cuts[0:k]
+    cuts[-1] = max_y
+
+    return cuts
+
+def quantiles(y, k=4):
+    """
+    Compute quantile breaks, the same as pysal's C{quantile}, which linearly
+    interpolates between the values on each side of a percentile.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  k: integer
+    @param k: The number of classes required.
+    @rtype: numpy.ndarray
+    @returns: The upper bound of each class.
+    """
+    values = _sorted(y)
+    n = len(values)
+
+    w = 100. / k
+    p = arange(w, 100 + w, w)
+    if p[-1] > 100.0:
+        p[-1] = 100.0
+
+    idx = p / 100. * (n - 1)
+    fraction = idx % 1
+    i = idx.astype(intp)
+    q = values[i]
+
+    # scipy returns the value itself, not an interpolation, when every
+    # percentile falls exactly on a value
+    if (fraction != 0).any():
+        q = q + (values[minimum(i + 1, n - 1)] - q) * fraction
+
+    return unique(q)
+
+def maximum_breaks(y, k=5, mindiff=0):
+    """
+    Compute Maximum Breaks, which are the midpoints of the k - 1 largest
+    differences between consecutive values. Like pysal, only the first gap of
+    each size is a break.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  k: integer
+    @param k: The number of classes required.
+    @type  mindiff: number
+    @param mindiff: The smallest difference between values that may be a break.
+    @rtype: numpy.ndarray
+    @returns: The upper bound of each class.
+    """
+    values = _sorted(y)
+
+    d = values[1:] - values[:-1]
+    diffs, first = unique(d, return_index=True)
+    keep = diffs > mindiff
+    first = first[keep]
+
+    # this mirrors pysal, where k = 1 keeps every gap
+    k1 = k - 1
+    if len(first) > k1:
+        first = first[-k1:]
+
+    if len(first) == 0:
+        return values[-1:].copy()
+
+    mp = sort((values[first] + values[first + 1]) / 2.)
+    return concatenate([mp, values[-1:]])
+
+def fisher_jenks(y, k=5):
+    """
+    Compute the Fisher Jenks optimal class breaks.
+
+    This is the dynamic program of pysal's C{_fisher_jenks_means}, solved by
+    divide and conquer. Of several partitions with the same deviations, the
+    one with the smallest start of the last class is kept, as in pysal, so
+    the breaks are the same, except where pysal's rounding errors choose
+    between equally good partitions. With fewer distinct values than
+    classes, some of the breaks are repeated, as in pysal; with fewer values
+    than classes, there is one class per value.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  k: integer
+    @param k: The number of classes required.
+    @rtype: list
+    @returns: The upper bound of each class.
+    """
+    values = _sorted(y)
+    k = min(k, len(values))
+    starts, deviations = _fisher_jenks_tables(values, k)
+    return _fisher_jenks_bins(values, starts, k)
+
+def fisher_jenks_range(y, kmax, kmin=2):
+    """
+    Compute the Fisher Jenks optimal class breaks for every number of classes
+    up to kmax. The dynamic program for kmax classes finds the optimal
+    partitions into fewer classes along the way, so this costs no more than
+    computing the breaks for kmax classes alone.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  kmax: integer
+    @param kmax: The largest number of classes required.
+    @type  kmin: integer
+    @param kmin: The smallest number of classes required.
+    @rtype: dict
+    @returns: The L{Breaks} for each number of classes, with their goodness
+        of variance fit.
+    """
+    values = _sorted(y)
+    n = len(values)
+    starts, deviations = _fisher_jenks_tables(values, min(kmax, n))
+
+    ranges = {}
+    for k in range(kmin, kmax + 1):
+        j = min(k, n)
+        ranges[k] = Breaks(_fisher_jenks_bins(values, starts, j),
+            gvf=_gvf(deviations[j, n], deviations[1, n]))
+    return ranges
+
+def _fisher_jenks_tables(values, k, weights=None):
+    """
+    Run the Fisher Jenks dynamic program on sorted values, optionally
+    weighted.
+
+    The sum of squared deviations of a class of sorted values is a Monge
+    cost, so the smallest best start of the last class never decreases as
+    values are added. Each row of the tables is filled by divide and conquer:
+    the best start for the middle value of a range bounds the best starts on
+    either side of it, and all the ranges of one level are searched at once.
+    This takes O(k n log n) time instead of the O(k n^2) of pysal. With
+    weights, the costs are weighted sums of squared deviations, which are
+    Monge costs as well.
+
+    @returns: Two (k + 1) by (n + 1) tables. In the first, element [j, l] is
+        the (1-based) index of the first value of the last class in the best
+        partition of the first l values into j classes. In the second, it is
+        the (weighted) sum of squared deviations from the class means of that
+        partition.
+    """
+    n = len(values)
+    x = values.astype(float64)
+    if weights is None:
+        w = ones(n, dtype=float64)
+    else:
+        w = asarray(weights, dtype=float64)
+    # centering the values keeps the prefix sums from losing precision
+    x -= (w * x).sum() / w.sum()
+
+    # prefix sums, so the deviation of values i to l-1 is a difference
+    s0 = concatenate([[0.], cumsum(w)])
+    s1 = concatenate([[0.], cumsum(w * x)])
+    s2 = concatenate([[0.], cumsum(w * x * x)])
+
+    mat1 = zeros((k + 1, n + 1), dtype=intp)
+    mat2 = zeros((k + 1, n + 1), dtype=float64)
+    mat1[1:, 1] = 1
+
+    l = arange(1, n + 1)
+    mat1[1, 1:] = 1
+    mat2[1, 1:] = _deviations(s0, s1, s2, zeros(n, dtype=intp), l)
+    tolerance = mat2[1, n] * 1e-12
+
+    for j in range(2, k + 1):
+        # the ranges of l still to fill, and the bounds of their best start
+        lo = array([2], dtype=intp)
+        hi = array([n], dtype=intp)
+        first = array([1], dtype=intp)
+        last = array([n - 1], dtype=intp)
+        while len(lo):
+            mid = (lo + hi) // 2
+            top = minimum(last, mid - 1)
+
+            # every candidate start of the last class, for every middle value
+            counts = top - first + 1
+            offsets = cumsum(counts) - counts
+            total = counts.sum()
+            i = arange(total) - repeat(offsets - first, counts)
+            end = repeat(mid, counts)
+            cost = mat2[j - 1, i] + _deviations(s0, s1, s2, i, end)
+
+            # pysal keeps the smallest start of several equal minima, and
+            # minima equal but for rounding are equal
+            least = minimum.reduceat(cost, offsets)
+            ties = (cost <= repeat(least + tolerance, counts)).nonzero()[0]
+            best = i[ties[searchsorted(ties, offsets)]]
+            mat2[j, mid] = least
+            mat1[j, mid] = best + 1
+
+            left = lo < mid
+            right = mid < hi
+            lo, hi, first, last = (concatenate([lo[left], mid[right] + 1]),
+                concatenate([mid[left] - 1, hi[right]]),
+                concatenate([first[left], best[right]]),
+                concatenate([best[left], last[right]]))
+
+    return mat1, mat2
+
+def _deviations(s0, s1, s2, i, l):
+    """
+    Get the weighted sums of squared deviations from the mean of the sorted
+    values i to l - 1, from the prefix sums of the weights, of the weighted
+    values and of their squares.
+    """
+    d1 = s1[l] - s1[i]
+    return (s2[l] - s2[i]) - d1 * d1 / (s0[l] - s0[i])
+
+def _fisher_jenks_bins(values, mat1, k):
+    """
+    Trace the class breaks of k classes back through the Fisher Jenks table
+    of class starts, the same way as pysal.
+    """
+    n = len(values)
+    kclass = [0] * (k + 1)
+    kclass[k] = float(values[n - 1])
+    last = n
+    for j in range(k, 1, -1):
+        pivot = mat1[j, last]
+        kclass[j - 1] = values[int(pivot - 2)]
+        last = int(pivot - 1)
+
+    return kclass[1:]
+
+def _gvf(sdcm, sdam):
+    """
+    Get the goodness of variance fit, from the sum of squared deviations from
+    the class means, and the sum of squared deviations from the mean.
+    """
+    if sdam == 0:
+        return 1.0
+    return 1.0 - sdcm / sdam
+
+def weighted_quantiles(y, weights, k=4):
+    """
+    Compute quantile breaks of weighted values. The breaks are the same as
+    pysal's C{quantile} of the values repeated by their weights, which
+    linearly interpolates between the values on each side of a percentile.
+
+    @type  y: numpy.ndarray
+    @param y: The sorted distinct values to classify.
+    @type  weights: numpy.ndarray
+    @param weights: The integer weight of each value.
+    @type  k: integer
+    @param k: The number of classes required.
+    @rtype: numpy.ndarray
+    @returns: The upper bound of each class.
+    """
+    # the position of the last repeat of each value, plus one
+    ends = cumsum(weights)
+    n = ends[-1]
+
+    w = 100. / k
+    p = arange(w, 100 + w, w)
+    if p[-1] > 100.0:
+        p[-1] = 100.0
+
+    q = []
+    for pct in p:
+        idx = pct / 100. * (n - 1)
+        lo = y[searchsorted(ends, int(idx), side='right')]
+        if idx % 1 == 0:
+            q.append(lo)
+        else:
+            hi = y[searchsorted(ends, int(idx) + 1, side='right')]
+            q.append(lo + (hi - lo) * (idx % 1))
+
+    return unique(array(q))
+
+def weighted_fisher_jenks(y, weights, k=5):
+    """
+    Compute the Fisher Jenks optimal class breaks of weighted values, which
+    minimize the weighted sum of squared deviations from the class means.
+
+    @type  y: numpy.ndarray
+    @param y: The sorted distinct values to classify.
+    @type  weights: numpy.ndarray
+    @param weights: The weight of each value.
+    @type  k: integer
+    @param k: The number of classes required.
+    @rtype: list
+    @returns: The upper bound of each class.
+    """
+    k = min(k, len(y))
+    starts, deviations = _fisher_jenks_tables(y, k, weights)
+    return _weighted_fisher_jenks_bins(y, starts, k)
+
+def weighted_fisher_jenks_range(y, weights, kmax, kmin=2):
+    """
+    Compute the Fisher Jenks optimal class breaks of weighted values for
+    every number of classes up to kmax, with one dynamic program.
+
+    @type  y: numpy.ndarray
+    @param y: The sorted distinct values to classify.
+    @type  weights: numpy.ndarray
+    @param weights: The weight of each value.
+    @type  kmax: integer
+    @param kmax: The largest number of classes required.
+    @type  kmin: integer
+    @param kmin: The smallest number of classes required.
+    @rtype: dict
+    @returns: The L{Breaks} for each number of classes, with their goodness
+        of variance fit.
+    """
+    m = len(y)
+    starts, deviations = _fisher_jenks_tables(y, min(kmax, m), weights)
+
+    ranges = {}
+    for k in range(kmin, kmax + 1):
+        j = min(k, m)
+        ranges[k] = Breaks(_weighted_fisher_jenks_bins(y, starts, j),
+            gvf=_gvf(deviations[j, m], deviations[1, m]))
+    return ranges
+
+def _weighted_fisher_jenks_bins(y, starts, k):
+    """
+    Trace the class breaks of k classes back through the Fisher Jenks table
+    of (1-based) class starts of weighted values.
+    """
+    bins = []
+    l = len(y)
+    for j in range(k, 0, -1):
+        bins.append(y[l - 1])
+        l = starts[j, l] - 1
+    bins.reverse()
+
+    return bins
+
+def weighted_jenks_caspall(y, weights, k=5, itmax=100):
+    """
+    Compute Jenks Caspall class breaks of weighted values. Like pysal, this
+    starts from quantile classes, and moves each value to the class with the
+    closest median until no value moves.
+
+    @type  y: numpy.ndarray
+    @param y: The sorted distinct values to classify.
+    @type  weights: numpy.ndarray
+    @param weights: The weight of each value.
+    @type  k: integer
+    @param k: The number of classes required.
+    @type  itmax: integer
+    @param itmax: The maximum number of iterations.
+    @rtype: list
+    @returns: The upper bound of each class.
+    """
+    q = weighted_quantiles(y, weights, k)
+    bounds = zeros(len(q) + 1, dtype=intp)
+    bounds[1:] = searchsorted(y, q, side='right')
+    bounds[-1] = len(y)
+
+    seeds = _class_medians(y, bounds, q.astype(float64), weights)
+    for it in range(itmax):
+        newbounds = _nearest_bounds(y, seeds)
+        if (newbounds == bounds).all():
+            break
+        bounds = newbounds
+        seeds = _class_medians(y, bounds, seeds, weights)
+
+    return [y[bounds[c+1] - 1] for c in range(len(seeds)) if bounds[c+1] > bounds[c]]
+
+def natural_breaks(y, k=5, initial=100, itmax=100):
+    """
+    Compute Natural Breaks, by iteratively moving k random seeds to the median
+    of the values closest to them, and keeping the best of several random
+    starts.
+
+    This is the same heuristic as pysal's C{natural_breaks}, but it works on
+    sorted values, where the values closest to each seed are contiguous. Each
+    iteration takes O(n) time and memory, instead of pysal's O(k*n) matrix of
+    distances. Unlike pysal, the start with the lowest fit is always kept.
+
+    @type  y: numpy.ndarray
+    @param y: The values to classify.
+    @type  k: integer
+    @param k: The number of classes required.
+    @type  initial: integer
+    @param initial: The number of additional random initial solutions to try.
+    @type  itmax: integer
+    @param itmax: The maximum number of iterations of each solution.
+    @rtype: list
+    @returns: The upper bound of each class.
+    """
+    values = _sorted(y)
+    uv = values[concatenate([[True], values[1:] != values[:-1]])]
+    k = min(k, len(uv))
+
+    sums = cumsum(values.astype(float64))
+    best = None
+    for i in range(initial + 1):
+        seeds = sort(uv[random.permutation(len(uv))[0:k]]).astype(float64)
+        bounds = _nearest_bounds(values, seeds)
+        for it in range(itmax):
+            seeds = _class_medians(values, bounds, seeds)
+            newbounds = _nearest_bounds(values, seeds)
+            if (newbounds == bounds).all():
+                break
+            bounds = newbounds
+
+        fit = _total_deviation(values, sums, seeds)
+        if best is None or fit < best[0]:
+            best = (fit, bounds,)
+
+    bounds = best[1]
+    return [values[bounds[c+1] - 1] for c in range(k) if bounds[c+1] > bounds[c]]
+
+def _sorted(y):
+    """
+    Get the values in ascending order, without sorting them if they already
+    are, as when they are fetched by the generator.
+    """
+    y = asarray(y)
+    if (y[1:] >= y[:-1]).all():
+        return y
+    return sort(y)
+
+def _nearest_bounds(values, seeds):
+    """
+    Get the index of the first sorted value closest to each seed, and the
+    number of values. Values halfway between two seeds belong to the lower one.
+    """
+    midpoints = (seeds[:-1] + seeds[1:]) / 2.
+    bounds = zeros(len(seeds) + 1, dtype=intp)
+    bounds[1:-1] = searchsorted(values, midpoints, side='right')
+    bounds[-1] = len(values)
+    return bounds
+
+def _class_medians(values, bounds, seeds, weights=None):
+    """
+    Get the median of each class of sorted values, optionally weighted. An
+    empty class keeps its seed.
+    """
+    medians = seeds.copy()
+    for c in range(len(seeds)):
+        lo, hi = bounds[c], bounds[c+1]
+        if hi <= lo:
+            continue
+        if weights is None:
+            medians[c] = median(values[lo:hi])
+        else:
+            cw = cumsum(weights[lo:hi])
+            medians[c] = values[lo + searchsorted(cw, cw[-1] / 2.)]
+    medians.sort()
+    return medians
+
+def _total_deviation(values, sums, seeds):
+    """
+    Get the sum of the absolute deviations of all the sorted values from each
+    of the seeds, which is the fit measure used by pysal.
+    """
+    n = len(values)
+    total = 0.0
+    for seed in seeds:
+        i = searchsorted(values, seed)
+        below = sums[i-1] if i > 0 else 0.0
+        total += seed * i - below + (sums[-1] - below) - seed * (n - i)
+    return total
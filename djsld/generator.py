@@ -29,10 +29,114 @@ limitations under the License.
 @version: 1.0.7
 """
 
+import logging
+import threading
+import django
+from uuid import uuid4
+from io import BytesIO
 from sld import *
-from numpy import array, ndarray
-from pysal.esda.mapclassify import *
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from numbers import Integral
+from numpy import arange, asarray, bincount, concatenate, empty, fromiter, float64, int64, \
+    isnan, lexsort, searchsorted, unique
+from numpy.random import RandomState
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, DecimalField, FloatField, IntegerField, Max, Q
+try:
+    from django.db.models import ExpressionWrapper
+except ImportError:
+    # django < 1.8, which has no expressions
+    ExpressionWrapper = None
+from django.core.exceptions import FieldError
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    # django < 1.11
+    from django.db.models.sql.datastructures import EmptyResultSet
 from django.contrib.gis.db.models import fields
+from djsld import pushdown as _pushdown
+from djsld import cache as _cache
+from djsld import classifiers as _classifiers
+from djsld import sketch as _sketch
+from djsld.render import merge_layers, merge_scales, render_categorize, render_first_match, \
+    render_sld, render_xml, set_shade, write_unique_values
+
+EXTRACT_CHUNK_SIZE = 10000
+"""The number of rows read from the database cursor at a time."""
+
+logger = logging.getLogger(__name__)
+
+class PysalClassifier(object):
+    """
+    A pysal classifier, imported on first use. Importing pysal also imports
+    scipy, which takes seconds, so djsld defers it until a classification
+    actually needs pysal. Classifications computed in the database, or by
+    the NumPy backend, never import it.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, name, module='pysal.esda.mapclassify'):
+        """
+        Create a lazily imported classifier.
+
+        @type  name: string
+        @param name: The name of the classifier class.
+        @type  module: string
+        @param module: The name of the module that defines the classifier.
+        """
+        self.__name__ = name
+        """The name of the classifier class."""
+
+        self.module = module
+        """The name of the module that defines the classifier."""
+
+        self._classifier = None
+
+    def load(self):
+        """
+        Import the classifier class.
+
+        @returns: The classifier class.
+        """
+        if self._classifier is None:
+            with self._lock:
+                module = __import__(self.module, {}, {}, [self.__name__])
+                self._classifier = getattr(module, self.__name__)
+
+        return self._classifier
+
+    def __call__(self, *args, **kwargs):
+        """
+        Classify the values with the classifier class.
+        """
+        return self.load()(*args, **kwargs)
+
+Equal_Interval = PysalClassifier('Equal_Interval')
+Fisher_Jenks = PysalClassifier('Fisher_Jenks')
+Jenks_Caspall = PysalClassifier('Jenks_Caspall')
+Jenks_Caspall_Forced = PysalClassifier('Jenks_Caspall_Forced')
+Jenks_Caspall_Sampled = PysalClassifier('Jenks_Caspall_Sampled')
+Max_P_Classifier = PysalClassifier('Max_P_Classifier')
+Maximum_Breaks = PysalClassifier('Maximum_Breaks')
+Natural_Breaks = PysalClassifier('Natural_Breaks')
+Quantiles = PysalClassifier('Quantiles')
+
+CLASSIFIERS = {
+    'as_equal_interval': Equal_Interval,
+    'as_fisher_jenks': Fisher_Jenks,
+    'as_jenks_caspall': Jenks_Caspall,
+    'as_jenks_caspall_forced': Jenks_Caspall_Forced,
+    'as_jenks_caspall_sampled': Jenks_Caspall_Sampled,
+    'as_max_p_classifier': Max_P_Classifier,
+    'as_maximum_breaks': Maximum_Breaks,
+    'as_natural_breaks': Natural_Breaks,
+    'as_quantiles': Quantiles
+}
+"""The classifier of each as_* function. A classifier is a callable with the
+name of a pysal classifier class, such as a L{PysalClassifier}."""
 
 def as_equal_interval(*args, **kwargs):
     """
@@ -55,7 +159,7 @@ def as_equal_interval(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Equal_Interval, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_equal_interval'], *args, **kwargs)
 
 def as_fisher_jenks(*args, **kwargs):
     """
@@ -78,7 +182,7 @@ def as_fisher_jenks(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Fisher_Jenks, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_fisher_jenks'], *args, **kwargs)
 
 def as_jenks_caspall(*args, **kwargs):
     """
@@ -101,7 +205,7 @@ def as_jenks_caspall(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Jenks_Caspall, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_jenks_caspall'], *args, **kwargs)
 
 def as_jenks_caspall_forced(*args, **kwargs):
     """
@@ -124,7 +228,7 @@ def as_jenks_caspall_forced(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Jenks_Caspall_Forced, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_jenks_caspall_forced'], *args, **kwargs)
 
 def as_jenks_caspall_sampled(*args, **kwargs):
     """
@@ -147,7 +251,7 @@ def as_jenks_caspall_sampled(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Jenks_Caspall_Sampled, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_jenks_caspall_sampled'], *args, **kwargs)
 
 def as_max_p_classifier(*args, **kwargs):
     """
@@ -170,7 +274,7 @@ def as_max_p_classifier(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Max_P_Classifier, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_max_p_classifier'], *args, **kwargs)
 
 def as_maximum_breaks(*args, **kwargs):
     """
@@ -193,7 +297,7 @@ def as_maximum_breaks(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Maximum_Breaks, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_maximum_breaks'], *args, **kwargs)
 
 def as_natural_breaks(*args, **kwargs):
     """
@@ -216,7 +320,7 @@ def as_natural_breaks(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Natural_Breaks, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_natural_breaks'], *args, **kwargs)
 
 def as_quantiles(*args, **kwargs):
     """
@@ -239,19 +343,301 @@ def as_quantiles(*args, **kwargs):
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD object that represents the class breaks.
     """
-    return _as_classification(Quantiles, *args, **kwargs)
+    return _as_classification(CLASSIFIERS['as_quantiles'], *args, **kwargs)
+
+def as_unique_values(queryset, field, geofield='geom', propertyname=None, userstyletitle=None, 
+    featuretypestylename=None, colorbrewername='', invertgradient=False, asxml=False, 
+    output=None, layout='rules', bycount=False, using=None):
+    """
+    Generate a class for each distinct value of a categorical field, such as
+    a land use code. The distinct values are grouped in the database, with
+    one GROUP BY query, and read into a list, since the colors depend on
+    their number. The SLD is written incrementally from the list, so that a
+    field with many thousands of values is never held in memory as an SLD
+    object, if an output is given. Otherwise, the XML is written to memory,
+    and returned with asxml, or parsed into an SLD object, which holds the
+    whole document in memory again. See L{djsld.render.write_unique_values}.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the data values.
+    @type  field: string
+    @param field: The name of the field on the model in the queryset that 
+        contains the data values.
+    @type  geofield: string
+    @keyword geofield: The name of the geography column on the model. Defaults to 'geom'
+    @type  propertyname: string
+    @keyword propertyname: The name of the filter property name, if different from the model field.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @type    colorbrewername: string
+    @keyword colorbrewername: The name of a colorbrewer ramp name. Must have as many colors as there are values.
+    @type    invertgradient: boolean
+    @keyword invertgradient: Should the colors go from high to low, instead of low to high?
+    @type    asxml: boolean
+    @keyword asxml: Should the SLD be returned as XML, instead of an SLD object?
+    @type    output: file
+    @keyword output: A file-like object, such as an HttpResponse, to write the XML to as it is produced, instead of returning it.
+    @type    layout: string
+    @keyword layout: The layout of the style: 'rules' for one rule per value, filtered by the value, or 'recode' for a single rule colored by a Recode function.
+    @type    bycount: boolean
+    @keyword bycount: Should the values be ordered from the most to the least common, instead of in ascending order?
+    @type    using: string
+    @keyword using: The alias of the database that the values are read from. Defaults to the DJSLD_DATABASE setting, or to the database of the queryset.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object with a class for each value, its XML if 
+        asxml is True, or the output if an output is given.
+    """
+    if not layout in ('rules', 'recode',):
+        raise ValueError('Unknown layout %r.' % (layout,))
+
+    queryset = _route(queryset, using)
+    symbolizer = _get_symbolizer(queryset, geofield)
+
+    if propertyname is None:
+        propertyname = field
+
+    # one row per distinct value
+    queryset = queryset.exclude(**{'%s__isnull' % field: True})
+    queryset = queryset.values_list(field).annotate(djsld_count=Count(field))
+    if bycount:
+        queryset = queryset.order_by('-djsld_count', field)
+    else:
+        queryset = queryset.order_by(field)
+
+    values = [value for value, n in queryset.iterator()]
+    count = len(values)
+    shades = _get_shades(count, count, colorbrewername, invertgradient)
+
+    name = '%d unique values of "%s"' % (count, field)
+
+    if output is None:
+        stream = BytesIO()
+    else:
+        stream = output
+
+    write_unique_values(stream, name, symbolizer, propertyname, values, shades, 
+        userstyletitle=userstyletitle, featuretypestylename=featuretypestylename, 
+        recode=layout == 'recode')
+
+    if not output is None:
+        return output
+    if asxml:
+        return stream.getvalue()
+
+    # python-sld parses its file with lxml, which reads file-like objects too
+    stream.seek(0)
+    return StyledLayerDescriptor(stream)
+
+def fisher_jenks_range(queryset, field, maxclasses, minclasses=2, compress=False, 
+    histogram=None, sample=None, seed=0, using=None):
+    """
+    Compute the Fisher-Jenks class breaks of the provided queryset for every
+    number of classes from minclasses to maxclasses. The values are fetched
+    once, and the breaks of fewer classes are read from the same dynamic
+    program as the breaks of maxclasses, so this is about as fast as one
+    call to L{as_fisher_jenks}. Each set of breaks has a goodness of variance
+    fit, which can be used to choose the number of classes, and may be
+    rendered with L{render_breaks}.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of
+        data values.
+    @type  field: string
+    @param field: The name of the field on the model in the queryset that 
+        contains the data values.
+    @type  maxclasses: integer
+    @param maxclasses: The largest number of classes desired.
+    @type    minclasses: integer
+    @keyword minclasses: The smallest number of classes desired. Defaults to 2.
+    @type    compress: boolean
+    @keyword compress: Should the distinct values and their counts be fetched, instead of every value? The breaks have the same goodness of fit, but equally good breaks may be chosen differently.
+    @type    histogram: integer
+    @keyword histogram: If given, classify the centers of this many histogram bins, as in L{as_fisher_jenks}.
+    @type    sample: integer
+    @keyword sample: If given, classify a random sample of about this many values, as in L{as_fisher_jenks}.
+    @type    seed: integer
+    @keyword seed: The seed of the random sample.
+    @type    using: string
+    @keyword using: The alias of the database that the values are read from, as in L{as_fisher_jenks}.
+    @rtype: dict
+    @returns: The L{djsld.classifiers.Breaks} for each number of classes, with
+        their C{gvf}, or an empty dict if the queryset is empty.
+    """
+    queryset = _route(queryset, using)
+
+    if histogram:
+        hist = _pushdown.histogram(queryset, field, histogram)
+        if hist is None:
+            return {}
+
+        ranges = _classifiers.weighted_fisher_jenks_range(hist.centers, hist.counts, 
+            maxclasses, minclasses)
+        for q in ranges.values():
+            # the top class must contain the largest value
+            q.bins[-1] = hist.maximum
+            q.error = hist.error
+        return ranges
+
+    datavalues = None
+    if sample:
+        datavalues, maximum = _extract_sample(queryset, field, sample, seed)
+
+    if not datavalues is None:
+        ranges = _classifiers.fisher_jenks_range(datavalues, maxclasses, minclasses)
+        for q in ranges.values():
+            q.bins[-1] = maximum
+        return ranges
+
+    if compress:
+        datavalues, counts = _extract_counts(queryset, field)
+        if len(datavalues) == 0:
+            return {}
+        return _classifiers.weighted_fisher_jenks_range(datavalues, counts, maxclasses, minclasses)
+
+    datavalues = _extract_values(queryset, field)
+    if len(datavalues) == 0:
+        return {}
+    return _classifiers.fisher_jenks_range(datavalues, maxclasses, minclasses)
+
+def render_breaks(queryset, field, breaks, geofield='geom', propertyname=None, 
+    userstyletitle=None, featuretypestylename=None, colorbrewername='', invertgradient=False, 
+    asxml=False, classname='Fisher_Jenks', layout='rules'):
+    """
+    Render class breaks that have already been computed, such as one of the
+    results of L{fisher_jenks_range}, without querying the data. The SLD is
+    the same as the SLD of the classifier with that number of classes.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set of the features to style.
+    @type  field: string
+    @param field: The name of the field on the model in the queryset that 
+        contains the data values.
+    @type  breaks: L{djsld.classifiers.Breaks}
+    @param breaks: The class breaks.
+    @type  geofield: string
+    @keyword geofield: The name of the geography column on the model. Defaults to 'geom'
+    @type  propertyname: string
+    @keyword propertyname: The name of the filter property name, if different from the model field.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @type    colorbrewername: string
+    @keyword colorbrewername: The name of a colorbrewer ramp name.
+    @type    invertgradient: boolean
+    @keyword invertgradient: Should the resulting SLD have colors from high to low, instead of low to high?
+    @type    asxml: boolean
+    @keyword asxml: Should the SLD be returned as XML, instead of an SLD object?
+    @type    classname: string
+    @keyword classname: The name of the classifier, for the name of the layer.
+    @type    layout: string
+    @keyword layout: The layout of the style: 'rules' for one filtered rule per class, 'first' for rules that only compare upper bounds, or 'categorize' for a single rule colored by a Categorize function.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object that represents the classification scheme 
+        and filters, or its XML if asxml is True.
+    """
+    symbolizer = _get_symbolizer(queryset, geofield)
+
+    if propertyname is None:
+        propertyname = field
+
+    name = '%d breaks on "%s" as %s' % (breaks.k, field, classname)
+
+    return _render(name, symbolizer, propertyname, breaks, breaks.k, colorbrewername=colorbrewername,
+        invertgradient=invertgradient, asxml=asxml, userstyletitle=userstyletitle, 
+        featuretypestylename=featuretypestylename, layout=layout)
+
+def classify_values(classification, values, nclasses, propertyname, geometry='Point', 
+    userstyletitle=None, featuretypestylename=None, colorbrewername='', invertgradient=False, 
+    asxml=False, backend=None, layout='rules', **kwargs):
+    """
+    Classify data values that are already in memory, or in the result of a
+    query, without a queryset. NumPy arrays are classified without copying
+    them, unless they are not sorted; buffers and memoryviews are viewed as
+    arrays, without copying them. A DB-API cursor is read like a queryset,
+    so raw SQL may be classified by executing it on a cursor from
+    C{django.db.connections}, and passing the cursor.
+
+    @type  classification: pysal classifier or string
+    @param classification: A classification class defined in pysal.esda.mapclassify, 
+        a L{PysalClassifier}, or the name of one, such as 'Quantiles'.
+    @type  values: numpy.ndarray, buffer, memoryview, sequence or cursor
+    @param values: The data values, or a cursor that executed a query selecting them as its first column. NULL and NaN values are skipped.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type  propertyname: string
+    @param propertyname: The name of the filter property name.
+    @type  geometry: string or symbolizer class
+    @keyword geometry: The type of the geometries to style, such as 'Point', 'LineString' or 'MultiPolygon', or the symbolizer class from the sld module. Defaults to 'Point'.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @type    colorbrewername: string
+    @keyword colorbrewername: The name of a colorbrewer ramp name.
+    @type    invertgradient: boolean
+    @keyword invertgradient: Should the resulting SLD have colors from high to low, instead of low to high?
+    @type    asxml: boolean
+    @keyword asxml: Should the SLD be returned as XML, instead of an SLD object?
+    @type    backend: string
+    @keyword backend: The classifier implementation to use: 'pysal' or 'numpy'. Defaults to the DJSLD_BACKEND setting, or 'pysal'.
+    @type    layout: string
+    @keyword layout: The layout of the style: 'rules' for one filtered rule per class, 'first' for rules that only compare upper bounds, or 'categorize' for a single rule colored by a Categorize function.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object that represents the classification scheme 
+        and filters, or its XML if asxml is True.
+    """
+    if isinstance(classification, basestring):
+        classification = PysalClassifier(classification)
+    if backend is None:
+        backend = getattr(settings, 'DJSLD_BACKEND', 'pysal')
+
+    symbolizer = _get_geometry_symbolizer(geometry)
+    name = '%d breaks on "%s" as %s' % (nclasses, propertyname, classification.__name__)
+
+    if nclasses == 1:
+        return _render_single(name, symbolizer, propertyname, userstyletitle=userstyletitle,
+            featuretypestylename=featuretypestylename, invertgradient=invertgradient, asxml=asxml)
+
+    if backend == 'numpy':
+        classification = _classifiers.CLASSIFIERS.get(classification.__name__, classification)
+
+    q = classification(_as_values(values), nclasses, **kwargs)
+
+    return _render(name, symbolizer, propertyname, q, nclasses, colorbrewername=colorbrewername,
+        invertgradient=invertgradient, asxml=asxml, userstyletitle=userstyletitle, 
+        featuretypestylename=featuretypestylename, layout=layout)
 
 def _as_classification(classification, queryset, field, nclasses, geofield='geom', 
     propertyname=None, userstyletitle=None, featuretypestylename=None, colorbrewername='',
-    invertgradient=False, **kwargs):
+    invertgradient=False, pushdown=True, cache=False, asxml=False, backend=None, 
+    compress=False, histogram=None, sample=None, seed=0, sketch=False, partitions=None, 
+    using=None, datavalues=None, threads=None, layers=False, groupby=None, layout='rules', 
+    scales=None, **kwargs):
     """
     Accept a queryset of objects, and return the values of the class breaks 
     on the data distribution. If the queryset is empty, no class breaks are
     computed.
 
+    If a list of fields is given, each field is classified separately, and
+    the values of the fields that need them are fetched in one query. The result is a dict
+    of the SLD of each field, or one SLD with a NamedLayer for each field if
+    layers is True.
+
+    If groupby is given, the values of each group of objects that share a
+    value of the groupby field are classified separately, and the result is
+    a dict of the SLD of each group, by group value. The breaks of every
+    group are computed in one query, or from the values of every group
+    fetched in one query.
+
     @type  classification: pysal classifier
     @param classification: A classification class defined in 
-        pysal.esda.mapclassify. As of version 1.0.1, this list is comprised of:
+        pysal.esda.mapclassify, or a L{PysalClassifier} that imports it. As 
+        of version 1.0.1, this list is comprised of:
 
           - Equal_Interval
           - Fisher_Jenks
@@ -265,14 +651,14 @@ def _as_classification(classification, queryset, field, nclasses, geofield='geom
 
     @type  queryset: QuerySet
     @param queryset: The query set that contains the entire distribution of data values.
-    @type     field: string
-    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type     field: string, expression or list
+    @param    field: The name of the field on the model in the queryset that contains the data values, a django expression of the data values, such as C{F('population') / Area('geom')}, or a list of them. Expressions are evaluated in the database, and need a propertyname, which must not be the name of a field on the model. Measures, such as C{Area('geom')}, and expressions that mix types are read as floats.
     @type  nclasses: integer
     @param nclasses: The number of class breaks desired.
     @type  geofield: string
     @keyword geofield: The name of the geography column on the model. Defaults to 'geom'
-    @type  propertyname: string
-    @keyword propertyname: The name of the filter property name, if different from the model field.
+    @type  propertyname: string or list
+    @keyword propertyname: The name of the filter property name, if different from the model field, or a list of names if a list of fields is given.
     @type  userstyletitle: string
     @keyword userstyletitle: The title of the UserStyle element.
     @type  featuretypestylename: string
@@ -281,27 +667,571 @@ def _as_classification(classification, queryset, field, nclasses, geofield='geom
     @keyword colorbrewername: The name of a colorbrewer ramp name. Must have the same # of corresponding classes as nclasses.
     @type    invertgradient: boolean
     @keyword invertgradient: Should the resulting SLD have colors from high to low, instead of low to high?
+    @type    pushdown: boolean
+    @keyword pushdown: Should the class breaks be computed in the database, when the classifier supports it? See L{djsld.pushdown}.
+    @type    cache: boolean
+    @keyword cache: Should the class breaks be stored in and retrieved from the django cache? See L{djsld.cache}.
+    @type    asxml: boolean
+    @keyword asxml: Should the SLD be returned as XML, instead of an SLD object? The XML is rendered from precompiled fragments, which is much faster than building an SLD object. See L{djsld.render}.
+    @type    backend: string
+    @keyword backend: The classifier implementation to use: 'pysal', or 'numpy' for the classifiers in L{djsld.classifiers}. Defaults to the DJSLD_BACKEND setting, or 'pysal'. Classifiers without a NumPy implementation always use pysal.
+    @type    compress: boolean
+    @keyword compress: Should the distinct values and their counts be fetched from the database, instead of every value? This is much faster for fields with many repeated values. See L{djsld.classifiers.classify_weighted}.
+    @type    histogram: integer
+    @keyword histogram: If given, approximate the distribution with a histogram of this many equal width bins, counted in the database, and classify the bin centers. Each break is a bin center, up to half a bin width from the values it separates; this error is logged. See L{djsld.pushdown.histogram}.
+    @type    sample: integer
+    @keyword sample: If given, classify a random sample of about this many values, instead of the entire distribution. The top break is always the largest value. On PostgreSQL 9.5 or later the sample is taken with TABLESAMPLE, elsewhere with reservoir sampling of the streamed values.
+    @type    seed: integer
+    @keyword seed: The seed of the random sample, so that samples are reproducible.
+    @type    sketch: boolean
+    @keyword sketch: Should quantiles of an unfiltered queryset be estimated from the stored quantile sketch of the field, if there is one? See L{djsld.sketch}.
+    @type    partitions: list
+    @keyword partitions: If given, the values are fetched from each of these query sets, or from the queryset on each of these database aliases, concurrently, and merged before classification. With compress, each partition is grouped into distinct values and counts. The partitions should together contain the data of the queryset.
+    @type    using: string
+    @keyword using: The alias of the database that the values are read from, such as a read replica. Defaults to the DJSLD_DATABASE setting, or to the database of the queryset. A database chosen with C{queryset.using()} is kept.
+    @type    datavalues: numpy.ndarray or function
+    @keyword datavalues: The sorted values of the field, if they have already been fetched, or a function that fetches them when the breaks are not cached or computed in the database.
+    @type    threads: integer
+    @keyword threads: If a list of fields or groupby is given, the number of threads that classify the fields or groups. By default, they are classified one at a time. If partitions are given, the number of threads that fetch them, which defaults to one per partition.
+    @type    layers: boolean
+    @keyword layers: If a list of fields is given, should one SLD be returned with a NamedLayer for each field, instead of a dict of SLDs? See L{djsld.render.merge_layers}.
+    @type    groupby: string
+    @keyword groupby: The name of the field on the model in the queryset that groups the objects, such as a region or a category, if each group is classified separately. The groups are classified from their exact values; compress, histogram, sample, sketch and partitions are not used.
+    @type    layout: string
+    @keyword layout: The layout of the style: 'rules' for one rule per class, filtered by its bounds; 'first' for one rule per class, filtered by its upper bound only, for map servers that stop at the first matching rule; or 'categorize' for a single rule, filtered by the largest break, whose color is a Symbology Encoding Categorize function of the property, which the map server evaluates with one lookup per feature. See L{djsld.render.render_first_match} and L{djsld.render.render_categorize}.
+    @type    scales: list
+    @keyword scales: If given, a list of (scale denominator, number of classes) pairs, in ascending order of scale denominator, for fewer classes at smaller scales. The nclasses classes are drawn up to the first scale denominator, and each number of classes from its scale denominator up to the next. The values are fetched at most once for every band, unless compress, histogram, sample or partitions are given. See L{djsld.render.merge_scales}.
     @type    kwargs: keywords
     @param   kwargs: Additional keyword arguments for the classifier.
     @rtype: L{sld.StyledLayerDescriptor}
     @returns: An SLD class object that represents the classification scheme 
-        and filters.
+        and filters, or its XML if asxml is True.
     """
-    thesld = StyledLayerDescriptor()
+    if backend is None:
+        backend = getattr(settings, 'DJSLD_BACKEND', 'pysal')
+    queryset = _route(queryset, using)
+
+    if _is_expression(field) or isinstance(field, (list, tuple,)) and any(map(_is_expression, field)):
+        queryset, partitions, field = _annotate(queryset, partitions, field, propertyname)
+        # the stored sketches are of model fields
+        sketch = False
+
+    if not groupby is None:
+        return _as_groups(classification, queryset, field, nclasses, groupby, 
+            geofield=geofield, propertyname=propertyname, userstyletitle=userstyletitle, 
+            featuretypestylename=featuretypestylename, colorbrewername=colorbrewername,
+            invertgradient=invertgradient, pushdown=pushdown, cache=cache, asxml=asxml, 
+            backend=backend, threads=threads, layout=layout, **kwargs)
+
+    if isinstance(field, (list, tuple,)):
+        return _as_classifications(classification, queryset, field, nclasses, 
+            propertyname=propertyname, asxml=asxml, threads=threads, layers=layers, 
+            geofield=geofield, userstyletitle=userstyletitle, 
+            featuretypestylename=featuretypestylename, colorbrewername=colorbrewername,
+            invertgradient=invertgradient, cache=cache, backend=backend, layout=layout, 
+            scales=scales, pushdown=pushdown, compress=compress, histogram=histogram, 
+            sample=sample, seed=seed, sketch=sketch, partitions=partitions, **kwargs)
+
+    if scales:
+        return _as_scales(classification, queryset, field, nclasses, scales, 
+            geofield=geofield, propertyname=propertyname, userstyletitle=userstyletitle, 
+            featuretypestylename=featuretypestylename, colorbrewername=colorbrewername,
+            invertgradient=invertgradient, asxml=asxml, backend=backend, 
+            datavalues=datavalues, layout=layout, pushdown=pushdown, cache=cache, 
+            compress=compress, histogram=histogram, sample=sample, seed=seed, sketch=sketch, 
+            partitions=partitions, threads=threads, **kwargs)
+
+    symbolizer = _get_symbolizer(queryset, geofield)
+
+    if propertyname is None:
+        propertyname = field
+
+    name = '%d breaks on "%s" as %s' % (nclasses, field, classification.__name__)
 
+    if nclasses == 1:
+        return _render_single(name, symbolizer, propertyname, userstyletitle=userstyletitle,
+            featuretypestylename=featuretypestylename, invertgradient=invertgradient, asxml=asxml)
+
+    # with more than one class, perform classification
+    options = {
+        'pushdown': pushdown,
+        'backend': backend,
+        'compress': compress,
+        'histogram': histogram,
+        'sample': sample,
+        'seed': seed,
+        'sketch': sketch,
+        'partitions': _get_partitions(queryset, partitions),
+        'threads': threads,
+        'datavalues': datavalues
+    }
+    classify = lambda: _classify(classification, queryset, field, nclasses, **dict(kwargs, **options))
+    if cache:
+        keyoptions = _key_options(backend, histogram, sample, seed, sketch)
+        q = _cache.get_or_classify(classification.__name__, queryset, field, nclasses, classify, 
+            options=keyoptions, **kwargs)
+    else:
+        q = classify()
+
+    return _render(name, symbolizer, propertyname, q, nclasses, colorbrewername=colorbrewername,
+        invertgradient=invertgradient, asxml=asxml, userstyletitle=userstyletitle, 
+        featuretypestylename=featuretypestylename, layout=layout)
+
+def _as_classifications(classification, queryset, fields, nclasses, propertyname=None, 
+    asxml=False, threads=None, layers=False, compress=False, histogram=None, sample=None, 
+    partitions=None, **kwargs):
+    """
+    Classify each of several fields of a queryset, from the values of every
+    field fetched in one query. The values are fetched only when the breaks
+    of a field are neither cached nor computed in the database, and not at
+    all with compress, histogram, sample or partitions, which read each
+    field separately.
+
+    @type  classification: pysal classifier
+    @param classification: A classification class defined in pysal.esda.mapclassify.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     fields: list
+    @param    fields: The names of the fields on the model in the queryset that contain the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type  propertyname: list
+    @keyword propertyname: The filter property name of each field, if different from the fields.
+    @type    asxml: boolean
+    @keyword asxml: Should the SLDs be returned as XML, instead of SLD objects?
+    @type    threads: integer
+    @keyword threads: The number of threads that classify the fields.
+    @type    layers: boolean
+    @keyword layers: Should one SLD be returned with a NamedLayer for each field?
+    @type    compress: boolean
+    @keyword compress: Should the distinct values of each field and their counts be fetched?
+    @type    histogram: integer
+    @keyword histogram: The number of histogram bins that approximate each field, if any.
+    @type    sample: integer
+    @keyword sample: The size of the random sample of each field to classify, if any.
+    @type    partitions: list
+    @keyword partitions: The query sets whose values of each field are fetched concurrently and merged, if any.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for L{_as_classification}.
+    @returns: A dict of the SLD of each field, or one SLD if layers is True.
+    """
+    if propertyname is None:
+        propertyname = fields
+
+    columns = {}
+    lock = threading.Lock()
+
+    def fetch(field):
+        def datavalues():
+            with lock:
+                if len(columns) == 0:
+                    columns.update(zip(fields, _extract_columns(queryset, fields)))
+            return columns[field]
+        return datavalues
+
+    def classify(args):
+        field, prop = args
+        datavalues = None
+        if nclasses > 1 and not (compress or histogram or sample or partitions):
+            datavalues = fetch(field)
+        return _as_classification(classification, queryset, field, nclasses, 
+            propertyname=prop, asxml=asxml and not layers, datavalues=datavalues, 
+            compress=compress, histogram=histogram, sample=sample, partitions=partitions, 
+            **kwargs)
+
+    slds = _map(classify, list(zip(fields, propertyname)), threads)
+
+    if not layers:
+        return dict(zip(fields, slds))
+
+    thesld = merge_layers(slds)
+    if asxml:
+        return thesld.as_sld()
+    return thesld
+
+def _as_groups(classification, queryset, field, nclasses, groupby, geofield='geom', 
+    propertyname=None, userstyletitle=None, featuretypestylename=None, colorbrewername='',
+    invertgradient=False, pushdown=True, cache=False, asxml=False, backend='pysal', 
+    threads=None, layout='rules', **kwargs):
+    """
+    Classify each group of objects in a queryset that share a value of a
+    field. The breaks of every group are computed in one query, when the
+    classifier supports it; the values of the remaining groups are fetched
+    in one query, and split into groups in python.
+
+    @type  classification: pysal classifier
+    @param classification: A classification class defined in pysal.esda.mapclassify.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type   groupby: string
+    @param  groupby: The name of the field on the model in the queryset that groups the objects.
+    @type    pushdown: boolean
+    @keyword pushdown: Should the class breaks of every group be computed in the database, when the classifier supports it?
+    @type    cache: boolean
+    @keyword cache: Should the class breaks of each group be stored in and retrieved from the django cache? The groups whose breaks are cached are neither computed nor fetched.
+    @type    threads: integer
+    @keyword threads: The number of threads that classify the groups.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @returns: A dict of the SLD of each group with values, by group value.
+    """
+    options = {
+        'geofield': geofield,
+        'propertyname': propertyname,
+        'userstyletitle': userstyletitle,
+        'featuretypestylename': featuretypestylename,
+        'colorbrewername': colorbrewername,
+        'invertgradient': invertgradient,
+        'asxml': asxml,
+        'layout': layout
+    }
+
+    if nclasses == 1:
+        # the style of one class does not depend on the values
+        queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+        keys = queryset.values_list(groupby, flat=True).distinct()
+        return dict((key, _as_classification(classification, queryset, field, 1, **options)) 
+            for key in keys)
+
+    group = lambda key: queryset.filter(_in_groups(groupby, [key]))
+    keyoptions = _key_options(backend)
+
+    # the cached groups are neither computed nor fetched
+    cached = {}
+    scope = queryset
+    if cache:
+        keys = list(queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+            .values_list(groupby, flat=True).distinct())
+        for key in keys:
+            q = _cache.get(classification.__name__, group(key), field, nclasses, 
+                options=keyoptions, **kwargs)
+            if not q is None:
+                cached[key] = q
+        if len(cached) > 0:
+            scope = queryset.filter(_in_groups(groupby, [key for key in keys if not key in cached]))
+
+    breaks = None
+    groups = {}
+    if not cache or len(cached) < len(keys):
+        if pushdown:
+            breaks = _pushdown.grouped(classification.__name__, scope, groupby, field, 
+                nclasses, **kwargs)
+
+        if breaks is None:
+            groups = _extract_groups(scope, field, groupby)
+        else:
+            remaining = [key for key in breaks if breaks[key] is None]
+            if len(remaining) > 0:
+                groups = _extract_groups(scope.filter(_in_groups(groupby, remaining)), field, groupby)
+
+    symbolizer = _get_symbolizer(queryset, geofield)
+    name = '%d breaks on "%s" as %s' % (nclasses, field, classification.__name__)
+
+    def classify(key):
+        if key in groups:
+            return _as_classification(classification, group(key), field, nclasses, cache=cache, 
+                backend=backend, datavalues=groups[key], **dict(kwargs, **options))
+
+        if key in cached:
+            q = cached[key]
+        elif cache:
+            q = _cache.get_or_classify(classification.__name__, group(key), field, nclasses, 
+                lambda: breaks[key], options=keyoptions, **kwargs)
+        else:
+            q = breaks[key]
+
+        return _render(name, symbolizer, propertyname or field, q, nclasses, 
+            colorbrewername=colorbrewername, invertgradient=invertgradient, asxml=asxml, 
+            userstyletitle=userstyletitle, featuretypestylename=featuretypestylename, 
+            layout=layout)
+
+    keys = list(cached.keys()) + list(groups.keys() if breaks is None else breaks.keys())
+    return dict(zip(keys, _map(classify, keys, threads)))
+
+def _as_scales(classification, queryset, field, nclasses, scales, geofield='geom', 
+    propertyname=None, userstyletitle=None, featuretypestylename=None, colorbrewername='',
+    invertgradient=False, asxml=False, backend='pysal', datavalues=None, layout='rules', 
+    compress=False, histogram=None, sample=None, partitions=None, **kwargs):
+    """
+    Classify a field with a different number of classes in each band of map
+    scales, and merge the rules of every band into one style. The values of
+    the field are fetched at most once, when the breaks of a band are
+    neither cached nor computed in the database, and not at all with
+    compress, histogram, sample or partitions, which each band reads
+    separately.
+
+    @type  classification: pysal classifier
+    @param classification: A classification class defined in pysal.esda.mapclassify.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of classes at the largest scales.
+    @type    scales: list
+    @param   scales: The (scale denominator, number of classes) pair of each smaller band of scales.
+    @type    datavalues: numpy.ndarray or function
+    @keyword datavalues: The sorted values of the field, if they have already been fetched, or a function that fetches them.
+    @type    compress: boolean
+    @keyword compress: Should the distinct values and their counts be fetched for each band?
+    @type    histogram: integer
+    @keyword histogram: The number of histogram bins that approximate the distribution, if any.
+    @type    sample: integer
+    @keyword sample: The size of the random sample to classify, if any.
+    @type    partitions: list
+    @keyword partitions: The query sets whose values are fetched concurrently and merged, if any.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for L{_as_classification}.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object with the rules of every band, or its XML if asxml is True.
+    """
+    denominators = [None] + [denominator for denominator, k in scales] + [None]
+    counts = [nclasses] + [k for denominator, k in scales]
+
+    if datavalues is None and not (compress or histogram or sample or partitions):
+        fetched = []
+        def datavalues():
+            if len(fetched) == 0:
+                fetched.append(_extract_values(queryset, field))
+            return fetched[0]
+
+    slds = []
+    for k in counts:
+        slds.append(_as_classification(classification, queryset, field, k, geofield=geofield, 
+            propertyname=propertyname, userstyletitle=userstyletitle, 
+            featuretypestylename=featuretypestylename, colorbrewername=colorbrewername, 
+            invertgradient=invertgradient, backend=backend, datavalues=datavalues, 
+            layout=layout, compress=compress, histogram=histogram, sample=sample, 
+            partitions=partitions, **kwargs))
+
+    thesld = merge_scales(slds, list(zip(denominators[:-1], denominators[1:])))
+    if asxml:
+        return thesld.as_sld()
+    return thesld
+
+def _key_options(backend, histogram=None, sample=None, seed=0, sketch=False):
+    """
+    Get the options of a classification that are part of its cache key.
+    Computing breaks in the database, or from distinct values, does not
+    change them.
+    """
+    return {
+        'backend': backend,
+        'histogram': histogram,
+        'sample': sample,
+        'seed': seed,
+        'sketch': sketch
+    }
+
+def _is_expression(field):
+    """
+    Determine if a field is a django expression, instead of a field name.
+    """
+    return hasattr(field, 'resolve_expression')
+
+def _annotate(queryset, partitions, field, propertyname):
+    """
+    Annotate the querysets of a classification with the expressions of its
+    fields, named after their filter property names, so that the rest of
+    the classification reads the expressions like fields. Expressions that
+    are not numbers are read as floats.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type  partitions: list
+    @param partitions: The query sets or database aliases of the partitions, if any.
+    @type     field: string, expression or list
+    @param    field: The field, or a list of fields, of which some are expressions.
+    @type  propertyname: string or list
+    @param propertyname: The filter property name of each field.
+    @returns: The annotated query set, the annotated partitions, and the
+        name of each field.
+    """
+    fields = list(field) if isinstance(field, (list, tuple,)) else [field]
+    names = propertyname if isinstance(field, (list, tuple,)) else [propertyname]
+    if names is None:
+        names = [None] * len(fields)
+
+    annotations = {}
+    for i, (f, name) in enumerate(zip(fields, names)):
+        if not _is_expression(f):
+            continue
+        if name is None:
+            raise ValueError('A propertyname is required to classify the expression %r.' % (f,))
+        annotations[name] = _as_number(f)
+        fields[i] = name
+
+    queryset = queryset.annotate(**annotations)
+    if partitions:
+        partitions = [p.annotate(**annotations) if hasattr(p, 'query') else p for p in partitions]
+
+    if isinstance(field, (list, tuple,)):
+        return queryset, partitions, fields
+    return queryset, partitions, fields[0]
+
+def _as_number(expression):
+    """
+    Wrap an expression whose output is not a number, such as an C{Area}
+    measure, or that combines fields of different types, such as
+    C{F('population') / Area('geom')}, so that its values are read as floats.
+    """
+    try:
+        output = expression.output_field
+    except (AttributeError, FieldError):
+        # the types of unresolved or mixed expressions are not known
+        output = None
+
+    if isinstance(output, (DecimalField, FloatField, IntegerField,)):
+        return expression
+    return ExpressionWrapper(expression, output_field=FloatField())
+
+def _in_groups(groupby, keys):
+    """
+    Get the filter of the objects in some groups. A NULL group is matched
+    with isnull, since NULL is never IN a list of values.
+    """
+    q = Q(**{'%s__in' % groupby: [key for key in keys if not key is None]})
+    if None in keys:
+        q = q | Q(**{'%s__isnull' % groupby: True})
+    return q
+
+def _map(function, items, threads=None):
+    """
+    Apply a function to each item, in a pool of threads if more than one
+    thread is requested.
+
+    @type  function: callable
+    @param function: The function of one item.
+    @type  items: list
+    @param items: The items.
+    @type  threads: integer
+    @param threads: The number of threads.
+    @rtype: list
+    @returns: The result for each item, in order.
+    """
+    if threads and threads > 1 and len(items) > 1:
+        pool = ThreadPool(min(threads, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+
+    return [function(item) for item in items]
+
+def _route(queryset, using=None):
+    """
+    Send the queries of a queryset to the database that djsld reads from:
+    the given alias, or the DJSLD_DATABASE setting. A database chosen with
+    C{queryset.using()} is kept, unless an alias is given.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set.
+    @type  using: string
+    @param using: The alias of the database.
+    @rtype: QuerySet
+    @returns: The query set on that database.
+    """
+    if using is None:
+        if not getattr(queryset, '_db', None) is None:
+            return queryset
+        using = getattr(settings, 'DJSLD_DATABASE', None)
+
+    if using is None:
+        return queryset
+    return queryset.using(using)
+
+def _get_symbolizer(queryset, geofield='geom'):
+    """
+    Get the symbolizer for the type of the geometry field of a queryset.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set of the features to style.
+    @type  geofield: string
+    @param geofield: The name of the geometry field.
+    @returns: The symbolizer class from the sld module.
+    """
     ftype = queryset.model._meta.get_field_by_name(geofield)[0]
     if isinstance(ftype, fields.LineStringField) or isinstance(ftype, fields.MultiLineStringField):
-        symbolizer = LineSymbolizer
+        return LineSymbolizer
     elif isinstance(ftype, fields.PolygonField) or isinstance(ftype, fields.MultiPolygonField):
-        symbolizer = PolygonSymbolizer
-    else:
-        # PointField, MultiPointField, GeometryField, or GeometryCollectionField
-        symbolizer = PointSymbolizer
+        return PolygonSymbolizer
 
-    if propertyname is None:
-        propertyname = field
+    # PointField, MultiPointField, GeometryField, or GeometryCollectionField
+    return PointSymbolizer
+
+def _get_geometry_symbolizer(geometry):
+    """
+    Get the symbolizer for a type of geometry.
+
+    @type  geometry: string or symbolizer class
+    @param geometry: The name of the geometry type, such as 'MultiPolygon', or the symbolizer class itself.
+    @returns: The symbolizer class from the sld module.
+    """
+    if not isinstance(geometry, basestring):
+        return geometry
+
+    geometry = geometry.upper()
+    if 'LINE' in geometry:
+        return LineSymbolizer
+    elif 'POLYGON' in geometry:
+        return PolygonSymbolizer
+
+    # Point, MultiPoint, Geometry, or GeometryCollection
+    return PointSymbolizer
 
-    nl = thesld.create_namedlayer('%d breaks on "%s" as %s' % (nclasses, field, classification.__name__))
+def _as_values(values, chunk_size=None):
+    """
+    Get data values as a sorted NumPy array, without copying them if they
+    already are one. NULL (None) and NaN values are skipped, as a queryset's
+    NULL values are, so they are in no class. A sequence or cursor of mixed
+    integers and floats is read as floats.
+
+    @type  values: numpy.ndarray, buffer, memoryview, sequence or cursor
+    @param values: The data values, or a DB-API cursor that selected them.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time from a cursor.
+    @rtype: numpy.ndarray
+    @returns: The sorted data values.
+    """
+    if hasattr(values, 'fetchmany'):
+        # rowcount is -1 if the driver does not know it
+        values = _read_columns(_fetch(values, chunk_size), max(values.rowcount, 0), 1, chunk_size)[0]
+        values.sort()
+        return values
+
+    values = asarray(values)
+    if values.dtype == object:
+        # a sequence with NULL values
+        values = _read_columns(((value,) for value in values), len(values), 1, chunk_size)[0]
+    elif values.dtype.kind == 'f' and isnan(values).any():
+        values = values[~isnan(values)]
+
+    return _classifiers._sorted(values)
+
+def _fetch(cursor, chunk_size=None):
+    """
+    Iterate over the rows of a DB-API cursor, fetching them in chunks.
+    """
+    chunk = cursor.fetchmany(chunk_size or EXTRACT_CHUNK_SIZE)
+    while len(chunk) > 0:
+        for row in chunk:
+            yield row
+        chunk = cursor.fetchmany(chunk_size or EXTRACT_CHUNK_SIZE)
+
+def _render_single(name, symbolizer, propertyname, userstyletitle=None, 
+    featuretypestylename=None, invertgradient=False, asxml=False):
+    """
+    Render the style of one class, a single static style with no filters.
+
+    @returns: An SLD class object, or its XML if asxml is True.
+    """
+    thesld = StyledLayerDescriptor()
+
+    nl = thesld.create_namedlayer(name)
     us = nl.create_userstyle()
     if not userstyletitle is None:
         us.Title = str(userstyletitle)
@@ -309,34 +1239,75 @@ def _as_classification(classification, queryset, field, nclasses, geofield='geom
     if not featuretypestylename is None:
         fts.Name = str(featuretypestylename)
 
-    # with just one class, make a single static style with no filters
-    if nclasses == 1:
-        rule = fts.create_rule(propertyname, symbolizer=symbolizer)
-        shade = 0 if invertgradient else 255
-        shade = '#%02x%02x%02x' % (shade, shade, shade,)
+    rule = fts.create_rule(propertyname, symbolizer=symbolizer)
+    shade = 0 if invertgradient else 255
+    shade = '#%02x%02x%02x' % (shade, shade, shade,)
 
-        # no filters for one class
-        if symbolizer == PointSymbolizer:
-            rule.PointSymbolizer.Graphic.Mark.Fill.CssParameters[0].Value = shade
-        elif symbolizer == LineSymbolizer:
-            rule.LineSymbolizer.Stroke.CssParameters[0].Value = shade
-        elif symbolizer == PolygonSymbolizer:
-            rule.PolygonSymbolizer.Stroke.CssParameters[0].Value = '#000000'
-            rule.PolygonSymbolizer.Fill.CssParameters[0].Value = shade
+    # no filters for one class
+    set_shade(rule, symbolizer, shade)
+
+    thesld.normalize()
 
-        thesld.normalize()
+    if asxml:
+        return thesld.as_sld()
+    return thesld
+
+def _render(name, symbolizer, propertyname, q, nclasses, colorbrewername='', invertgradient=False,
+    asxml=False, userstyletitle=None, featuretypestylename=None, layout='rules'):
+    """
+    Render class breaks as an SLD object, or as XML.
 
+    @type    layout: string
+    @keyword layout: The layout of the style: 'rules' for one filtered rule per class, 'first' for rules evaluated until the first match, or 'categorize' for one rule colored by a Categorize function.
+    @returns: An SLD class object, or its XML if asxml is True.
+    """
+    shades = _get_shades(q.k, nclasses, colorbrewername, invertgradient)
+
+    if layout in ('categorize', 'first',):
+        if layout == 'categorize':
+            render = render_categorize
+        else:
+            render = render_first_match
+
+        thesld = render(name, symbolizer, propertyname, q.bins, shades, 
+            userstyletitle=userstyletitle, featuretypestylename=featuretypestylename)
+        if asxml:
+            return thesld.as_sld()
         return thesld
+    elif layout != 'rules':
+        raise ValueError('Unknown layout %r.' % (layout,))
 
-    # with more than one class, perform classification
-    datavalues = array(queryset.order_by(field).values_list(field, flat=True))
-    q = classification(datavalues, nclasses, **kwargs)
+    if asxml:
+        render = render_xml
+    else:
+        render = render_sld
 
+    return render(name, symbolizer, propertyname, q.bins, shades, 
+        userstyletitle=userstyletitle, featuretypestylename=featuretypestylename)
+
+def _get_shades(k, nclasses, colorbrewername='', invertgradient=False):
+    """
+    Get the color of each class. If a colorbrewer ramp is requested, and it
+    has a scheme with nclasses colors, and the classification produced that
+    many classes, the colors of that scheme are used. Otherwise, the classes
+    are shaded from white to black.
+
+    @type  k: integer
+    @param k: The number of classes produced by the classification.
+    @type  nclasses: integer
+    @param nclasses: The number of classes requested.
+    @type    colorbrewername: string
+    @keyword colorbrewername: The name of a colorbrewer ramp name.
+    @type    invertgradient: boolean
+    @keyword invertgradient: Should the colors go from high to low, instead of low to high?
+    @rtype: list
+    @returns: The color of each class, as a '#rrggbb' string.
+    """
     shades = None
-    if q.k == nclasses and colorbrewername and not colorbrewername == '':
+    if k == nclasses and colorbrewername and not colorbrewername == '':
         try:
             import colorbrewer
-            shades = getattr(colorbrewer, colorbrewername)[nclasses]
+            shades = list(getattr(colorbrewer, colorbrewername)[nclasses])
 
             if invertgradient:
                 shades.reverse()
@@ -344,47 +1315,505 @@ def _as_classification(classification, queryset, field, nclasses, geofield='geom
             # could not import colorbrewer, or nclasses unavailable
             pass
 
-    for i,qbin in enumerate(q.bins):
-        if type(qbin) == ndarray:
-            qbin = qbin[0]
+    if shades:
+        return ['#%02x%02x%02x' % shade for shade in shades]
+
+    colors = []
+    for i in range(k):
+        shade = (float(k - i) / k ) * 255
+        if invertgradient:
+            shade = 255 - shade
+        colors.append('#%02x%02x%02x' % (shade, shade, shade,))
+
+    return colors
+
+def _classify(classification, queryset, field, nclasses, pushdown=True, backend='pysal', 
+    compress=False, histogram=None, sample=None, seed=0, sketch=False, partitions=None, 
+    threads=None, datavalues=None, **kwargs):
+    """
+    Compute the class breaks of the data distribution in a queryset.
+
+    @type  classification: pysal classifier
+    @param classification: A classification class defined in pysal.esda.mapclassify.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type    pushdown: boolean
+    @keyword pushdown: Should the class breaks be computed in the database, when the classifier supports it?
+    @type    backend: string
+    @keyword backend: The classifier implementation to use: 'pysal' or 'numpy'.
+    @type    compress: boolean
+    @keyword compress: Should the distinct values and their counts be fetched, instead of every value?
+    @type    histogram: integer
+    @keyword histogram: The number of histogram bins that approximate the distribution, if any.
+    @type    sample: integer
+    @keyword sample: The size of the random sample to classify, if any.
+    @type    seed: integer
+    @keyword seed: The seed of the random sample.
+    @type    sketch: boolean
+    @keyword sketch: Should quantiles be estimated from the stored quantile sketch of the field?
+    @type    partitions: list
+    @keyword partitions: The query sets whose values are fetched concurrently and merged, if any.
+    @type    threads: integer
+    @keyword threads: The number of threads that fetch the partitions.
+    @type    datavalues: numpy.ndarray or function
+    @keyword datavalues: The sorted values of the field, if they have already
+        been fetched, or a function that fetches them, which is not called if
+        the breaks are computed from a sketch or in the database.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @returns: An object with the C{bins} and C{k} attributes of a pysal classifier.
+    """
+    fetch = None
+    if callable(datavalues):
+        fetch, datavalues = datavalues, None
+
+    if sketch and datavalues is None and classification.__name__ == 'Quantiles' and len(kwargs) == 0:
+        q = _sketch.quantiles(queryset, field, nclasses)
+        if not q is None:
+            return q
+
+    if pushdown and datavalues is None and not partitions:
+        q = _pushdown.classify(classification.__name__, queryset, field, nclasses, **kwargs)
+        if not q is None:
+            return q
+
+    if backend == 'numpy':
+        classification = _classifiers.CLASSIFIERS.get(classification.__name__, classification)
+
+    if not fetch is None:
+        datavalues = fetch()
+
+    if not datavalues is None:
+        return classification(datavalues, nclasses, **kwargs)
+
+    if partitions:
+        if compress:
+            datavalues, counts = _extract_partitions(partitions, field, True, threads)
+            return _classifiers.classify_weighted(classification, datavalues, counts, nclasses, **kwargs)
+
+        datavalues = _extract_partitions(partitions, field, False, threads)
+        return classification(datavalues, nclasses, **kwargs)
+
+    if histogram:
+        hist = _pushdown.histogram(queryset, field, histogram)
+        if not hist is None:
+            q = _classifiers.classify_weighted(classification, hist.centers, hist.counts, 
+                nclasses, exact=False, **kwargs)
+
+            # the top class must contain the largest value
+            bins = list(q.bins)
+            bins[-1] = hist.maximum
+
+            logger.info('Classified "%s" as %s from %d histogram bins; breaks are within %s.',
+                field, classification.__name__, len(hist.counts), hist.error)
+
+            return _classifiers.Breaks(bins, error=hist.error)
+
+    if sample:
+        datavalues, maximum = _extract_sample(queryset, field, sample, seed)
+        if not datavalues is None:
+            q = classification(datavalues, nclasses, **kwargs)
+
+            # the top class must contain the largest value
+            bins = list(q.bins)
+            bins[-1] = maximum
+
+            return _classifiers.Breaks(bins)
+
+    if compress:
+        datavalues, counts = _extract_counts(queryset, field)
+        return _classifiers.classify_weighted(classification, datavalues, counts, nclasses, **kwargs)
+
+    datavalues = _extract_values(queryset, field)
+    return classification(datavalues, nclasses, **kwargs)
 
-        title = '<= %s' % qbin
-        rule = fts.create_rule(title, symbolizer=symbolizer)
+def _extract_values(queryset, field, chunk_size=None):
+    """
+    Read the values of a field from a queryset into a sorted NumPy array.
+
+    The values are streamed from the database without an ORDER BY clause, in
+    chunks of L{EXTRACT_CHUNK_SIZE} rows (see L{_iterate}), and copied into a
+    buffer of one 64-bit number per row. Integer fields produce an integer
+    array; all other fields produce a float array. NULL values are skipped.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: numpy.ndarray
+    @returns: The sorted data values.
+    """
+    queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+    rows = _iterate(queryset.values_list(field), chunk_size)
+    values = _read_columns(rows, 0, 1, chunk_size)[0]
+
+    # pysal expects the values in order; sorting in place is much cheaper
+    # than asking the database to do it
+    values.sort()
+
+    return values
+
+def _iterate(queryset, chunk_size=None):
+    """
+    Iterate over the rows of a values_list queryset.
+
+    The rows are read with the queryset iterator, so django converts the
+    values, logs the query, and manages the cursor. On PostgreSQL, django
+    1.11 and later read the iterator through a server-side cursor, so only
+    one chunk is held in memory; django 2.0 and later read chunk_size rows
+    at a time. With older versions of django, which would read the entire
+    result into the client first, PostgreSQL rows are read through a named,
+    server-side psycopg2 cursor, chunk_size rows at a time, and are not
+    converted; the cursor is closed however the iteration ends.
 
-        if shades:
-            shade = '#%02x%02x%02x' % shades[i]
+    @type  queryset: QuerySet
+    @param queryset: The values_list query set.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @returns: An iterator of the rows, as tuples of values.
+    """
+    if chunk_size is None:
+        chunk_size = EXTRACT_CHUNK_SIZE
+
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql' or django.VERSION >= (1, 11):
+        if django.VERSION >= (2, 0):
+            rows = queryset.iterator(chunk_size=chunk_size)
         else:
-            shade = (float(q.k - i) / q.k ) * 255
-            if invertgradient:
-                shade = 255 - shade
-            shade = '#%02x%02x%02x' % (shade, shade, shade,)
-
-        if symbolizer == PointSymbolizer:
-            rule.PointSymbolizer.Graphic.Mark.Fill.CssParameters[0].Value = shade
-        elif symbolizer == LineSymbolizer:
-            rule.LineSymbolizer.Stroke.CssParameters[0].Value = shade
-        elif symbolizer == PolygonSymbolizer:
-            rule.PolygonSymbolizer.Stroke.CssParameters[0].Value = '#000000'
-            rule.PolygonSymbolizer.Fill.CssParameters[0].Value = shade
-
-        # now add the filters
-        if i > 0:
-            f_low = Filter(rule)
-            f_low.PropertyIsGreaterThan = PropertyCriterion(f_low, 'PropertyIsGreaterThan')
-            f_low.PropertyIsGreaterThan.PropertyName = propertyname
-            f_low.PropertyIsGreaterThan.Literal = str(q.bins[i-1])
-
-        f_high = Filter(rule)
-        f_high.PropertyIsLessThanOrEqualTo = PropertyCriterion(f_high, 'PropertyIsLessThanOrEqualTo')
-        f_high.PropertyIsLessThanOrEqualTo.PropertyName = propertyname
-        f_high.PropertyIsLessThanOrEqualTo.Literal = str(qbin)
-
-       
-        if i > 0:
-            rule.Filter = f_low + f_high
+            rows = queryset.iterator()
+        for row in rows:
+            yield row
+        return
+
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return
+
+    if hasattr(connection, 'ensure_connection'):
+        connection.ensure_connection()
+    else:
+        # django < 1.6 connects when the first cursor is created
+        connection.cursor().close()
+
+    # a holdable cursor outlives the transaction, so it works in autocommit
+    # mode, but keeps its rows on the server until it is closed
+    cursor = connection.connection.cursor(name='djsld_%s' % uuid4().hex, withhold=True)
+    try:
+        cursor.itersize = chunk_size
+        if settings.DEBUG:
+            # record the query in connection.queries, as django's cursors do
+            connection.make_debug_cursor(cursor).execute(sql, params)
         else:
-            rule.Filter = f_high
-           
-    thesld.normalize()
+            cursor.execute(sql, params)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
 
-    return thesld
+def _extract_columns(queryset, fields, chunk_size=None):
+    """
+    Read the values of several fields from a queryset into sorted NumPy
+    arrays, in one query. NULL values are skipped in each field separately.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     fields: list
+    @param    fields: The names of the fields on the model in the queryset that contain the data values.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: list
+    @returns: The sorted data values of each field.
+    """
+    queryset = queryset.order_by()
+    rows = _iterate(queryset.values_list(*fields), chunk_size)
+    columns = _read_columns(rows, 0, len(fields), chunk_size)
+
+    for values in columns:
+        values.sort()
+
+    return columns
+
+def _extract_groups(queryset, field, groupby, chunk_size=None):
+    """
+    Read the values of a field from a queryset, and split them by the value
+    of another field, in one query. Each group key is replaced with a number
+    as it is read, and the values are sorted by group number and value
+    together, so that each group is a sorted slice of the same array.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type   groupby: string
+    @param  groupby: The name of the field on the model in the queryset that groups the values.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: dict
+    @returns: The sorted data values of each group with values, by group value.
+    """
+    queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+    rows = _iterate(queryset.values_list(field, groupby), chunk_size)
+
+    keys = []
+    codes = {}
+    def encode(rows):
+        for value, key in rows:
+            if not key in codes:
+                codes[key] = len(keys)
+                keys.append(key)
+            yield value, codes[key]
+
+    values, groups = _read_columns(encode(rows), 0, 2, chunk_size)
+
+    order = lexsort((values, groups))
+    values = values[order]
+    bounds = searchsorted(groups[order], arange(len(keys) + 1))
+
+    return dict((key, values[bounds[i]:bounds[i + 1]]) for i, key in enumerate(keys))
+
+def _get_partitions(queryset, partitions):
+    """
+    Get the query set of each partition, given as a query set or as a
+    database alias.
+    """
+    if not partitions:
+        return None
+
+    return [p if hasattr(p, 'query') else queryset.using(p) for p in partitions]
+
+def _extract_partitions(querysets, field, compress=False, threads=None):
+    """
+    Read the values of a field from several query sets concurrently, each on
+    its own database connection, and merge them.
+
+    @type  querysets: list
+    @param querysets: The query sets of the partitions.
+    @type     field: string
+    @param    field: The name of the field on the model in the query sets that contains the data values.
+    @type  compress: boolean
+    @param compress: Should the distinct values and their counts be read, instead of every value?
+    @type  threads: integer
+    @param threads: The number of threads, which defaults to one per partition.
+    @returns: The sorted values, or the sorted distinct values and their
+        counts if compress is True.
+    """
+    def extract(queryset):
+        try:
+            if compress:
+                return _extract_counts(queryset, field)
+            return _extract_values(queryset, field)
+        finally:
+            # connections are per thread, and pool threads are discarded
+            if not threading.current_thread() is caller:
+                connections[queryset.db].close()
+
+    caller = threading.current_thread()
+    parts = _map(extract, querysets, threads or len(querysets))
+
+    # an empty partition is a float array, which would make integers floats
+    if compress:
+        parts = [part for part in parts if len(part[0]) > 0] or parts[:1]
+        values, inverse = unique(concatenate([part[0] for part in parts]), return_inverse=True)
+        counts = bincount(inverse, weights=concatenate([part[1] for part in parts]))
+        return values, counts.astype(int64)
+
+    parts = [part for part in parts if len(part) > 0] or parts[:1]
+    values = concatenate(parts)
+    # the partitions are sorted runs, which a merge sort merges quickly
+    values.sort(kind='mergesort')
+    return values
+
+def _extract_counts(queryset, field, chunk_size=None):
+    """
+    Read the distinct values of a field from a queryset, and the number of
+    rows with each value, into sorted NumPy arrays. The values are grouped in
+    the database, so only one row per distinct value is transferred.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: tuple
+    @returns: The sorted distinct values, and the number of rows with each value.
+    """
+    queryset = queryset.exclude(**{'%s__isnull' % field: True})
+    queryset = queryset.values_list(field).annotate(Count(field)).order_by()
+    values, counts = _read_columns(_iterate(queryset, chunk_size), 0, 2, chunk_size)
+
+    order = values.argsort()
+    return values[order], counts[order]
+
+def _extract_sample(queryset, field, size, seed=0, chunk_size=None):
+    """
+    Read a random sample of the values of a field from a queryset into a
+    sorted NumPy array.
+
+    On PostgreSQL 9.5 or later, each row of the queryset's table is sampled
+    with the probability that yields the requested sample size, using
+    C{TABLESAMPLE BERNOULLI} (see L{_tablesample}). Otherwise, or if that
+    sample is empty, the values are streamed and reservoir sampled, so only
+    the sample is kept in memory. If the queryset has no more values than
+    the sample size, all values are read.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  size: integer
+    @param size: The number of values in the sample.
+    @type  seed: integer
+    @keyword seed: The seed of the random sample.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: tuple
+    @returns: The sorted sample and the largest value of the queryset, or
+        (None, None) if the queryset has no more values than the sample size.
+    """
+    if chunk_size is None:
+        chunk_size = EXTRACT_CHUNK_SIZE
+
+    queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+    stats = queryset.aggregate(n=Count(field), hi=Max(field))
+    if stats['n'] <= size:
+        return None, None
+
+    # TABLESAMPLE ... REPEATABLE requires PostgreSQL 9.5
+    if _pushdown._pg_version(queryset) >= 90500:
+        sampled = _tablesample(queryset, 100. * size / stats['n'], seed)
+        values = _read_columns(_iterate(sampled.values_list(field), chunk_size), size, 1, chunk_size)[0]
+
+        # a small table may have no sampled rows at all
+        if len(values) > 0:
+            values.sort()
+
+            logger.info('Classifying "%s" from a sample of %d of %d values.', field, len(values), stats['n'])
+
+            return values, stats['hi']
+
+    random = RandomState(seed)
+    rows = (value for value, in _iterate(queryset.values_list(field), chunk_size))
+
+    reservoir = None
+    seen = 0
+    chunk = list(islice(rows, chunk_size))
+    while len(chunk) > 0:
+        if reservoir is None:
+            dtype = int64 if isinstance(chunk[0], Integral) and not isinstance(chunk[0], bool) else float64
+            reservoir = empty(size, dtype=dtype)
+        values = fromiter(chunk, dtype=reservoir.dtype, count=len(chunk))
+
+        # fill the reservoir, then replace a random member with each value
+        # with the probability size / (number of values seen)
+        nfill = max(0, min(size - seen, len(values)))
+        reservoir[seen:seen + nfill] = values[:nfill]
+        seen += nfill
+        values = values[nfill:]
+        if len(values) > 0:
+            slots = (random.random_sample(len(values)) * arange(seen + 1, seen + len(values) + 1)).astype(int64)
+            keep = slots < size
+            reservoir[slots[keep]] = values[keep]
+            seen += len(values)
+
+        chunk = list(islice(rows, chunk_size))
+
+    reservoir.sort()
+
+    logger.info('Classifying "%s" from a sample of %d of %d values.', field, size, seen)
+
+    return reservoir, stats['hi']
+
+def _tablesample(queryset, percent, seed):
+    """
+    Restrict a queryset to the rows of its model's table that are in a
+    PostgreSQL C{TABLESAMPLE} of the table. The sample is a subquery on the
+    primary key, so the queryset's own joins, aliases and subqueries are
+    left as they are.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set to sample.
+    @type  percent: float
+    @param percent: The probability that a row is sampled, in percent.
+    @type  seed: integer
+    @param seed: The seed of the random sample.
+    @rtype: QuerySet
+    @returns: The sampled query set.
+    """
+    quote = connections[queryset.db].ops.quote_name
+    table = quote(queryset.model._meta.db_table)
+    pk = quote(queryset.model._meta.pk.column)
+
+    # the queryset's first occurrence of its table is not aliased
+    where = '%s.%s IN (SELECT %s FROM %s TABLESAMPLE BERNOULLI (%%s) REPEATABLE (%%s))' % (
+        table, pk, pk, table)
+    return queryset.extra(where=[where], params=[float(percent), int(seed)])
+
+def _read_columns(rows, nrows, ncolumns, chunk_size=None):
+    """
+    Read rows of values into one NumPy array per column.
+
+    The rows are read in chunks, and copied into buffers preallocated for the
+    expected number of rows, which double in size whenever they are full.
+    Columns whose values are all integers produce integer arrays; a column
+    becomes a float array as soon as any other value, such as a float or a
+    Decimal, is read, and the integers read before it are converted. NULL
+    (None) values are skipped, so columns may have different lengths.
+
+    @type  rows: iterator
+    @param rows: The rows, as tuples of values.
+    @type  nrows: integer
+    @param nrows: The expected number of rows, or 0 if it is not known.
+    @type  ncolumns: integer
+    @param ncolumns: The number of columns in each row.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time.
+    @rtype: list
+    @returns: An array of the values of each column.
+    """
+    if chunk_size is None:
+        chunk_size = EXTRACT_CHUNK_SIZE
+
+    bufs = [None] * ncolumns
+    filled = [0] * ncolumns
+
+    chunk = list(islice(rows, chunk_size))
+    while len(chunk) > 0:
+        for i, column in enumerate(zip(*chunk)):
+            if None in column:
+                column = [value for value in column if not value is None]
+                if len(column) == 0:
+                    continue
+
+            if bufs[i] is None or bufs[i].dtype == int64:
+                integral = all(isinstance(value, Integral) and not isinstance(value, bool) 
+                    for value in column)
+                if bufs[i] is None:
+                    bufs[i] = empty(max(nrows, len(column)), dtype=int64 if integral else float64)
+                elif not integral:
+                    # the first value that is not an integer makes the column floats
+                    bufs[i] = bufs[i].astype(float64)
+
+            buf = bufs[i]
+            end = filled[i] + len(column)
+            if end > len(buf):
+                buf.resize(max(end, 2 * len(buf)), refcheck=False)
+            buf[filled[i]:end] = fromiter(column, dtype=buf.dtype, count=len(column))
+            filled[i] = end
+
+        chunk = list(islice(rows, chunk_size))
+
+    for i, buf in enumerate(bufs):
+        if buf is None:
+            bufs[i] = empty(0, dtype=float64)
+        elif filled[i] < len(buf):
+            buf.resize(filled[i], refcheck=False)
+
+    return bufs
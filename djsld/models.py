@@ -0,0 +1,48 @@
+"""
+Models that djsld stores in the database.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+from django.db import models
+
+class QuantileSketch(models.Model):
+    """
+    The quantile sketch of the values of a field of a model. See
+    L{djsld.sketch}.
+    """
+
+    model = models.CharField(max_length=255)
+    """The app label and name of the model, such as 'myapp.Hydrant'."""
+
+    field = models.CharField(max_length=255)
+    """The name of the field, which may traverse related models."""
+
+    data = models.TextField()
+    """The serialized L{djsld.sketch.TDigest}."""
+
+    stale = models.BooleanField(default=False)
+    """Was the table changed in bulk since the digest was built? See L{djsld.sketch.expire}."""
+
+    class Meta:
+        unique_together = ('model', 'field',)
@@ -0,0 +1,441 @@
+"""
+Compute class breaks inside the database.
+
+Some classifiers only need a few summary statistics of the data distribution.
+Instead of transferring every value to python, the functions in this module
+ask the database for those statistics, and compute the same breaks that the
+corresponding pysal classifier would compute from the full distribution.
+
+Each function returns a L{djsld.classifiers.Breaks} object, or None if the
+classification cannot be computed in the database (for example, on a
+database backend other than PostgreSQL, or with unsupported classifier
+options). Callers should fall back to classifying the full distribution
+when None is returned. The grouped functions return a dictionary of the
+breaks of every group of values instead, with None for the groups that
+they cannot be computed for.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+from itertools import islice
+from numbers import Integral
+from numpy import arange, array, bincount, float64, floor, fromiter, int64, \
+    intp, minimum, unique, zeros
+from django.db import connections
+from django.db.models import Max, Min
+from djsld.classifiers import Breaks
+
+def classify(classname, queryset, field, nclasses, **kwargs):
+    """
+    Compute class breaks in the database, if the classifier supports it.
+
+    @type  classname: string
+    @param classname: The name of the pysal classifier, such as 'Quantiles'.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they cannot be computed in the database.
+    """
+    if not classname in CLASSIFIERS:
+        return None
+
+    return CLASSIFIERS[classname](queryset, field, nclasses, **kwargs)
+
+def equal_interval(queryset, field, nclasses, **kwargs):
+    """
+    Compute Equal Interval breaks from the minimum and maximum values. This
+    uses the django aggregation framework, and works with any database backend.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they cannot be computed in the database.
+    """
+    if len(kwargs) > 0:
+        return None
+
+    bounds = queryset.order_by().aggregate(lo=Min(field), hi=Max(field))
+    if bounds['lo'] is None or bounds['lo'] == bounds['hi']:
+        return None
+
+    return _equal_interval(_as_number(bounds['lo']), _as_number(bounds['hi']), nclasses)
+
+def quantiles(queryset, field, nclasses, **kwargs):
+    """
+    Compute Quantile breaks with the PostgreSQL C{percentile_cont} ordered-set
+    aggregate. This requires PostgreSQL 9.4 or later; on older servers, None
+    is returned.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they cannot be computed in the database.
+    """
+    if len(kwargs) > 0 or _pg_version(queryset) < 90400:
+        return None
+
+    fractions = _fractions(nclasses)
+    sql, params = _values_sql(queryset, field)
+    sql = 'SELECT count(v), min(v), percentile_cont(%%s::double precision[]) ' \
+        'WITHIN GROUP (ORDER BY v) FROM (%s) AS djsld_values(v)' % sql
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, [fractions] + list(params))
+        count, min_y, scores = cursor.fetchone()
+    if count == 0:
+        return None
+
+    return _quantiles(count, min_y, scores, fractions)
+
+def maximum_breaks(queryset, field, nclasses, mindiff=0):
+    """
+    Compute Maximum Breaks from the largest gaps between consecutive distinct
+    values, using the PostgreSQL C{lead} window function.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type  mindiff: number
+    @keyword mindiff: The minimum difference between class breaks.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they cannot be computed in the database.
+    """
+    if not _is_postgresql(queryset):
+        return None
+
+    # the gap above the maximum value is NULL, which sorts first
+    sql, params = _values_sql(queryset, field)
+    sql = 'SELECT DISTINCT ON (gap) gap, lo, hi FROM (' \
+        'SELECT v AS lo, lead(v) OVER (ORDER BY v) AS hi, ' \
+        'lead(v) OVER (ORDER BY v) - v AS gap FROM (' \
+        'SELECT DISTINCT v::double precision AS v FROM (%s) AS djsld_values(v)' \
+        ') AS djsld_distinct) AS djsld_gaps ' \
+        'WHERE gap IS NULL OR gap > %%s ' \
+        'ORDER BY gap DESC, lo LIMIT %%s' % sql
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, list(params) + [mindiff, nclasses])
+        rows = cursor.fetchall()
+    if len(rows) < 2:
+        # no data, or a single distinct value
+        return None
+
+    # this mirrors pysal.esda.mapclassify.Maximum_Breaks
+    mp = [(lo + hi) / 2. for gap, lo, hi in rows if not gap is None]
+    mp.append(rows[0][1])
+    mp.sort()
+
+    return Breaks(mp)
+
+class Histogram(object):
+    """
+    The number of values in each of a series of equal width bins.
+    """
+
+    def __init__(self, centers, counts, width, maximum):
+        """
+        Create a histogram.
+
+        @type  centers: numpy.ndarray
+        @param centers: The center of each non-empty bin, in ascending order.
+        @type  counts: numpy.ndarray
+        @param counts: The number of values in each non-empty bin.
+        @type  width: float
+        @param width: The width of each bin.
+        @type  maximum: number
+        @param maximum: The largest value.
+        """
+        self.centers = centers
+        """The center of each non-empty bin."""
+
+        self.counts = counts
+        """The number of values in each non-empty bin."""
+
+        self.width = width
+        """The width of each bin."""
+
+        self.maximum = maximum
+        """The largest value."""
+
+    @property
+    def error(self):
+        """
+        The largest distance between a value and the center of its bin, which
+        is the largest error of a class break computed from the bin centers.
+        """
+        return self.width / 2.
+
+def histogram(queryset, field, nbins, chunk_size=10000):
+    """
+    Count the values of a field in equal width bins between the minimum and
+    maximum values. On PostgreSQL, the values are counted in the database
+    with C{width_bucket}. On other databases, the values are streamed and
+    counted in chunks, so only the counts are kept in memory.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nbins: integer
+    @param nbins: The number of bins.
+    @type  chunk_size: integer
+    @keyword chunk_size: The number of rows to read at a time, on databases other than PostgreSQL.
+    @rtype: L{Histogram}
+    @returns: The histogram, or None if there are no values.
+    """
+    bounds = queryset.order_by().aggregate(lo=Min(field), hi=Max(field))
+    if bounds['lo'] is None:
+        return None
+
+    maximum = _as_number(bounds['hi'])
+    lo = float(bounds['lo'])
+    hi = float(bounds['hi'])
+    if lo == hi:
+        count = queryset.exclude(**{'%s__isnull' % field: True}).count()
+        return Histogram(array([lo]), array([count]), 0., maximum)
+
+    counts = zeros(nbins, dtype=int64)
+    if _is_postgresql(queryset):
+        # the maximum value is in bucket nbins + 1, so move it into the last bin
+        sql, params = _values_sql(queryset, field)
+        sql = 'SELECT least(width_bucket(v::double precision, %%s::double precision, ' \
+            '%%s::double precision, %%s), %%s) AS bucket, count(*) ' \
+            'FROM (%s) AS djsld_values(v) GROUP BY bucket' % sql
+
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(sql, [lo, hi, nbins, nbins] + list(params))
+            for bucket, count in cursor.fetchall():
+                counts[bucket - 1] = count
+    else:
+        queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+        rows = queryset.values_list(field, flat=True).iterator()
+        chunk = list(islice(rows, chunk_size))
+        while len(chunk) > 0:
+            values = fromiter(chunk, dtype=float64, count=len(chunk))
+            buckets = minimum(floor((values - lo) * nbins / (hi - lo)).astype(intp), nbins - 1)
+            counts += bincount(buckets, minlength=nbins)
+            chunk = list(islice(rows, chunk_size))
+
+    width = (hi - lo) / nbins
+    centers = lo + width * (arange(nbins) + 0.5)
+    nonempty = counts > 0
+
+    return Histogram(centers[nonempty], counts[nonempty], width, maximum)
+
+CLASSIFIERS = {
+    'Equal_Interval': equal_interval,
+    'Quantiles': quantiles,
+    'Maximum_Breaks': maximum_breaks,
+}
+"""The classifiers that may be computed in the database, by pysal class name."""
+
+def grouped(classname, queryset, groupby, field, nclasses, **kwargs):
+    """
+    Compute the class breaks of every group of a queryset in one query, if
+    the classifier supports it.
+
+    @type  classname: string
+    @param classname: The name of the pysal classifier, such as 'Quantiles'.
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type   groupby: string
+    @param  groupby: The name of the field on the model in the queryset that identifies the group of each value.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @type    kwargs: keywords
+    @param   kwargs: Additional keyword arguments for the classifier.
+    @rtype: dictionary
+    @returns: The class breaks of each group with values, by group value,
+        or None if they cannot be computed in the database. The breaks of a
+        group are None if they cannot be computed in the database.
+    """
+    if not classname in GROUPED_CLASSIFIERS:
+        return None
+
+    return GROUPED_CLASSIFIERS[classname](queryset, groupby, field, nclasses, **kwargs)
+
+def grouped_equal_interval(queryset, groupby, field, nclasses, **kwargs):
+    """
+    Compute Equal Interval breaks from the minimum and maximum values of
+    every group. This uses the django aggregation framework, and works with
+    any database backend.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type   groupby: string
+    @param  groupby: The name of the field on the model in the queryset that identifies the group of each value.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @rtype: dictionary
+    @returns: The class breaks of each group, by group value, or None if they cannot be computed in the database.
+    """
+    if len(kwargs) > 0:
+        return None
+
+    queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+    rows = queryset.values(groupby).annotate(lo=Min(field), hi=Max(field))
+
+    breaks = {}
+    for row in rows:
+        if row['lo'] == row['hi']:
+            # a single distinct value is left to pysal, as in equal_interval
+            breaks[row[groupby]] = None
+        else:
+            breaks[row[groupby]] = _equal_interval(_as_number(row['lo']), _as_number(row['hi']), nclasses)
+    return breaks
+
+def grouped_quantiles(queryset, groupby, field, nclasses, **kwargs):
+    """
+    Compute Quantile breaks of every group with the PostgreSQL
+    C{percentile_cont} ordered-set aggregate. This requires PostgreSQL 9.4
+    or later; on older servers, None is returned.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type   groupby: string
+    @param  groupby: The name of the field on the model in the queryset that identifies the group of each value.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @rtype: dictionary
+    @returns: The class breaks of each group, by group value, or None if they cannot be computed in the database.
+    """
+    if len(kwargs) > 0 or _pg_version(queryset) < 90400:
+        return None
+
+    fractions = _fractions(nclasses)
+    sql, params = _values_sql(queryset, field, groupby)
+    sql = 'SELECT g, count(v), min(v), percentile_cont(%%s::double precision[]) ' \
+        'WITHIN GROUP (ORDER BY v) FROM (%s) AS djsld_values(v, g) GROUP BY g' % sql
+
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(sql, [fractions] + list(params))
+        rows = cursor.fetchall()
+
+    breaks = {}
+    for group, count, min_y, scores in rows:
+        breaks[group] = _quantiles(count, min_y, scores, fractions)
+    return breaks
+
+GROUPED_CLASSIFIERS = {
+    'Equal_Interval': grouped_equal_interval,
+    'Quantiles': grouped_quantiles,
+}
+"""The classifiers that may be computed for every group in the database, by pysal class name."""
+
+def _equal_interval(min_y, max_y, nclasses):
+    """
+    Compute Equal Interval breaks from the minimum and maximum values.
+    """
+    # this mirrors pysal.esda.mapclassify.Equal_Interval
+    width = (max_y - min_y) * 1. / nclasses
+    cuts = arange(min_y + width, max_y + width, width)
+    if len(cuts) > nclasses:
+        cuts = cuts[0:nclasses]
+    cuts[-1] = max_y
+
+    return Breaks(cuts)
+
+def _fractions(nclasses):
+    """
+    Get the fractions of the distribution at each Quantile break.
+    """
+    # this mirrors pysal.esda.mapclassify.quantile
+    w = 100. / nclasses
+    pcts = arange(w, 100 + w, w)
+    if pcts[-1] > 100.0:
+        pcts[-1] = 100.0
+    return [float(p) / 100. for p in pcts]
+
+def _quantiles(count, min_y, scores, fractions):
+    """
+    Compute Quantile breaks from the percentiles that the database computed.
+    """
+    scores = array(scores)
+    # scipy returns the value itself, not an interpolation, when every
+    # percentile falls exactly on a data value
+    if isinstance(min_y, Integral) and \
+        all((f * (count - 1)) % 1 == 0 for f in fractions):
+        scores = scores.astype(int64)
+
+    return Breaks(unique(scores))
+
+def _values_sql(queryset, field, *fields):
+    """
+    Get the SQL and parameters of a query that selects the non-NULL values of
+    a field, and optionally of other fields in the same rows, in no
+    particular order.
+    """
+    queryset = queryset.exclude(**{'%s__isnull' % field: True}).order_by()
+    query = queryset.values_list(field, *fields).query
+    return query.get_compiler(queryset.db).as_sql()
+
+def _is_postgresql(queryset):
+    """
+    Determine if the database that a queryset is bound to is PostgreSQL.
+    """
+    return connections[queryset.db].vendor == 'postgresql'
+
+def _pg_version(queryset):
+    """
+    Get the version of the PostgreSQL server that a queryset is bound to, as
+    an integer such as 90400, or 0 on other databases.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return 0
+
+    if connection.connection is None:
+        # the version is read from the open connection
+        connection.cursor().close()
+    return getattr(connection, 'pg_version', 0) or 0
+
+def _as_number(value):
+    """
+    Convert a database value to a python number that numpy can operate on.
+    """
+    if isinstance(value, Integral):
+        return value
+    return float(value)
@@ -0,0 +1,536 @@
+"""
+Render class breaks as SLD documents.
+
+Class breaks may be rendered as a python-sld L{sld.StyledLayerDescriptor}
+object with L{render_sld}, or directly as SLD XML with L{render_xml}. The
+latter builds a python-sld document only once per symbolizer type, with
+placeholders in place of the layer name, titles, property names, break
+values and colors. The serialized document is split into fragments at the
+placeholders, and each later request only fills the fragments in. Since the
+fragments are serialized by python-sld itself, both methods produce the same
+XML.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+import re, threading
+from lxml.etree import Element, SubElement, xmlfile
+from sld import *
+
+_PLACEHOLDER = re.compile(r'\{djsld:(\w+)\}'.encode('ascii'))
+_skeletons = {}
+_skeletons_lock = threading.Lock()
+
+def render_sld(name, symbolizer, propertyname, bins, shades, userstyletitle=None, 
+    featuretypestylename=None):
+    """
+    Render class breaks as an SLD object, with one rule per class.
+
+    @type  name: string
+    @param name: The name of the NamedLayer element.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of each rule.
+    @type  propertyname: string
+    @param propertyname: The name of the filter property.
+    @type  bins: sequence
+    @param bins: The upper bound of each class, in ascending order.
+    @type  shades: list
+    @param shades: The color of each class, as a '#rrggbb' string.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object that represents the classification scheme
+        and filters.
+    """
+    thesld = StyledLayerDescriptor()
+
+    nl = thesld.create_namedlayer(name)
+    us = nl.create_userstyle()
+    if not userstyletitle is None:
+        us.Title = str(userstyletitle)
+    fts = us.create_featuretypestyle()
+    if not featuretypestylename is None:
+        fts.Name = str(featuretypestylename)
+
+    literals = [_literal(qbin) for qbin in bins]
+    for i,literal in enumerate(literals):
+        rule = fts.create_rule('<= %s' % literal, symbolizer=symbolizer)
+        set_shade(rule, symbolizer, shades[i])
+
+        # now add the filters
+        if i > 0:
+            f_low = Filter(rule)
+            f_low.PropertyIsGreaterThan = PropertyCriterion(f_low, 'PropertyIsGreaterThan')
+            f_low.PropertyIsGreaterThan.PropertyName = propertyname
+            f_low.PropertyIsGreaterThan.Literal = literals[i-1]
+
+        f_high = _upper_filter(rule, propertyname, literal)
+
+        if i > 0:
+            rule.Filter = f_low + f_high
+        else:
+            rule.Filter = f_high
+
+    thesld.normalize()
+
+    return thesld
+
+def render_xml(name, symbolizer, propertyname, bins, shades, userstyletitle=None, 
+    featuretypestylename=None):
+    """
+    Render class breaks as SLD XML, with one rule per class. The result is
+    identical to the serialization of L{render_sld}, but is produced without
+    building an SLD object.
+
+    @type  name: string
+    @param name: The name of the NamedLayer element.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of each rule.
+    @type  propertyname: string
+    @param propertyname: The name of the filter property.
+    @type  bins: sequence
+    @param bins: The upper bound of each class, in ascending order.
+    @type  shades: list
+    @param shades: The color of each class, as a '#rrggbb' string.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @rtype: bytes
+    @returns: The SLD XML document.
+    """
+    head, first, rest, tail = _get_skeleton(symbolizer, 
+        not userstyletitle is None, not featuretypestylename is None)
+
+    values = {
+        'name': name,
+        'title': userstyletitle,
+        'ftsname': featuretypestylename,
+        'property': propertyname
+    }
+    chunks = []
+    _fill(chunks, head, values)
+
+    literals = [_literal(qbin) for qbin in bins]
+    for i,literal in enumerate(literals):
+        values['rule'] = '<= %s' % literal
+        values['shade'] = shades[i]
+        values['high'] = literal
+        if i > 0:
+            values['low'] = literals[i-1]
+            _fill(chunks, rest, values)
+        else:
+            _fill(chunks, first, values)
+
+    _fill(chunks, tail, values)
+
+    return b''.join(chunks)
+
+def render_first_match(name, symbolizer, propertyname, bins, shades, userstyletitle=None, 
+    featuretypestylename=None):
+    """
+    Render class breaks as an SLD object, with one rule per class, for map
+    servers that stop at the first rule that matches a feature. The
+    FeatureTypeStyle has the GeoServer C{ruleEvaluation} vendor option set
+    to C{first}, and the rules are in ascending order, so each rule only
+    compares a feature with the upper bound of its class, which halves the
+    comparisons of L{render_sld}.
+
+    The top class compares with the largest break too, instead of having an
+    ElseFilter, so features above the largest break, or without a value,
+    are not drawn, and every feature is drawn in the same class as with
+    L{render_sld}.
+
+    @type  name: string
+    @param name: The name of the NamedLayer element.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of each rule.
+    @type  propertyname: string
+    @param propertyname: The name of the filter property.
+    @type  bins: sequence
+    @param bins: The upper bound of each class, in ascending order.
+    @type  shades: list
+    @param shades: The color of each class, as a '#rrggbb' string.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object that represents the classification scheme
+        and filters.
+    """
+    thesld = StyledLayerDescriptor()
+
+    nl = thesld.create_namedlayer(name)
+    us = nl.create_userstyle()
+    if not userstyletitle is None:
+        us.Title = str(userstyletitle)
+    fts = us.create_featuretypestyle()
+    if not featuretypestylename is None:
+        fts.Name = str(featuretypestylename)
+
+    literals = [_literal(qbin) for qbin in bins]
+    for i,literal in enumerate(literals):
+        rule = fts.create_rule('<= %s' % literal, symbolizer=symbolizer)
+        set_shade(rule, symbolizer, shades[i])
+        rule.Filter = _upper_filter(rule, propertyname, literal)
+
+    thesld.normalize()
+
+    # python-sld does not know vendor options, so add it once the rules are in order
+    namespace = fts._nsmap['sld']
+    option = SubElement(fts._node, '{%s}VendorOption' % namespace, name='ruleEvaluation')
+    option.text = 'first'
+
+    return thesld
+
+def render_categorize(name, symbolizer, propertyname, bins, shades, userstyletitle=None, 
+    featuretypestylename=None):
+    """
+    Render class breaks as an SLD object with a single rule, whose color is
+    chosen by a Symbology Encoding C{Categorize} function of the property.
+    The map server looks up the class of each feature once, instead of
+    evaluating the filters of every rule.
+
+    The thresholds of the function are the upper bounds of all but the last
+    class, and belong to the preceding class, as the upper bounds of the
+    rules of L{render_sld} do. Categorize would also color features above
+    the largest break, and give features without a value whatever color the
+    map server chooses, so the rule has a filter on the largest break, and
+    draws the same features in the same colors as L{render_sld}.
+
+    @type  name: string
+    @param name: The name of the NamedLayer element.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of the rule.
+    @type  propertyname: string
+    @param propertyname: The name of the classified property.
+    @type  bins: sequence
+    @param bins: The upper bound of each class, in ascending order.
+    @type  shades: list
+    @param shades: The color of each class, as a '#rrggbb' string.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object that represents the classification scheme.
+    """
+    thesld = StyledLayerDescriptor()
+
+    nl = thesld.create_namedlayer(name)
+    us = nl.create_userstyle()
+    if not userstyletitle is None:
+        us.Title = str(userstyletitle)
+    fts = us.create_featuretypestyle()
+    if not featuretypestylename is None:
+        fts.Name = str(featuretypestylename)
+
+    rule = fts.create_rule(propertyname, symbolizer=symbolizer)
+    set_shade(rule, symbolizer, shades[0])
+
+    # the arguments are the property, the first color, then each threshold
+    # and the color above it
+    literals = [_literal(qbin) for qbin in bins]
+    arguments = [shades[0]]
+    for i in range(1, len(shades)):
+        arguments.extend([literals[i-1], shades[i]])
+    arguments.append('preceding')
+
+    parameter = _get_shade_parameter(rule, symbolizer)._node
+    parameter.text = None
+    function = SubElement(parameter, '{%s}Function' % rule._nsmap['ogc'], name='Categorize')
+    SubElement(function, '{%s}PropertyName' % rule._nsmap['ogc']).text = propertyname
+    for argument in arguments:
+        SubElement(function, '{%s}Literal' % rule._nsmap['ogc']).text = argument
+
+    # features above the largest break, or without a value, are not drawn
+    rule.Filter = _upper_filter(rule, propertyname, literals[-1])
+
+    thesld.normalize()
+
+    return thesld
+
+def write_unique_values(output, name, symbolizer, propertyname, values, shades, 
+    userstyletitle=None, featuretypestylename=None, recode=False):
+    """
+    Write SLD XML with a class for each distinct value of a property. The
+    document is written to the output incrementally, with
+    C{lxml.etree.xmlfile}, so a style with many thousands of values is never
+    held in memory, neither as an SLD object nor as XML.
+
+    Each value has a rule with a C{PropertyIsEqualTo} filter, or with recode,
+    a single rule is colored by a Symbology Encoding C{Recode} function that
+    maps each value to its color.
+
+    @type  output: file
+    @param output: The file-like object to write to.
+    @type  name: string
+    @param name: The name of the NamedLayer element.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of each rule.
+    @type  propertyname: string
+    @param propertyname: The name of the filter property.
+    @type  values: iterable
+    @param values: The distinct values, which may be an iterator.
+    @type  shades: list
+    @param shades: The color of each value, as a '#rrggbb' string.
+    @type  userstyletitle: string
+    @keyword userstyletitle: The title of the UserStyle element.
+    @type  featuretypestylename: string
+    @keyword featuretypestylename: The name of the FeatureTypeStyle element.
+    @type  recode: boolean
+    @keyword recode: Should a single rule with a Recode function be written, instead of a rule per value?
+    """
+    # a document with one placeholder rule is the template of every rule
+    thesld = render_sld(name, symbolizer, propertyname, ['{djsld:value}'], ['{djsld:shade}'], 
+        userstyletitle=userstyletitle, featuretypestylename=featuretypestylename)
+    rule = thesld.NamedLayer.UserStyle.FeatureTypeStyle.Rules[0]
+    parameter = _get_shade_parameter(rule, symbolizer)._node
+    rule = rule._node
+    ogc = thesld._nsmap['ogc']
+
+    def write_rules(xf):
+        equal = {'{%s}PropertyIsLessThanOrEqualTo' % ogc: '{%s}PropertyIsEqualTo' % ogc}
+        for value, shade in zip(values, shades):
+            text = u'%s' % (value,)
+            texts = {'<= {djsld:value}': text, '{djsld:value}': text, '{djsld:shade}': shade}
+            _write(xf, rule, texts, tags=equal)
+
+    def write_recode(xf):
+        with xf.element(parameter.tag, dict(parameter.attrib)):
+            with xf.element('{%s}Function' % ogc, name='Recode'):
+                with xf.element('{%s}PropertyName' % ogc):
+                    xf.write(propertyname)
+                for value, shade in zip(values, shades):
+                    for text in (u'%s' % (value,), shade,):
+                        with xf.element('{%s}Literal' % ogc):
+                            xf.write(text)
+
+    if recode:
+        texts = {'<= {djsld:value}': propertyname}
+        hooks = {rule.find('{%s}Filter' % ogc): None, parameter: write_recode}
+    else:
+        texts = {}
+        hooks = {rule: write_rules}
+
+    with xmlfile(output, encoding=None) as xf:
+        _write(xf, thesld._node, texts, hooks=hooks, nsmap=thesld._node.nsmap)
+
+def merge_layers(slds):
+    """
+    Merge SLD objects into one SLD, with the NamedLayer elements of each in
+    order. The first SLD is modified and returned.
+
+    @type  slds: list
+    @param slds: The L{sld.StyledLayerDescriptor} objects to merge.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object with a NamedLayer for each layer in slds.
+    """
+    thesld = slds[0]
+    for other in slds[1:]:
+        for layer in other._node.xpath('sld:NamedLayer', namespaces=other._nsmap):
+            thesld._node.append(layer)
+
+    thesld.normalize()
+
+    return thesld
+
+def merge_scales(slds, scales):
+    """
+    Merge the styles of several bands of map scales into the style of the
+    first SLD, with the rules of each band in order. Each rule is drawn from
+    the minimum scale denominator of its band, inclusive, to the maximum,
+    exclusive. The first SLD is modified and returned.
+
+    @type  slds: list
+    @param slds: The L{sld.StyledLayerDescriptor} object of each band.
+    @type  scales: list
+    @param scales: The (minimum, maximum) scale denominators of each band,
+        either of which may be None for no limit.
+    @rtype: L{sld.StyledLayerDescriptor}
+    @returns: An SLD class object with the rules of every band.
+    """
+    thesld = slds[0]
+    path = 'sld:NamedLayer/sld:UserStyle/sld:FeatureTypeStyle/sld:Rule'
+
+    last = None
+    for other, (minscale, maxscale) in zip(slds, scales):
+        for rule in other._node.xpath(path, namespaces=other._nsmap):
+            _set_scales(rule, minscale, maxscale)
+            if not other is thesld:
+                # after the rules of the previous band, and before any vendor options
+                last.addnext(rule)
+            last = rule
+
+    return thesld
+
+def set_shade(rule, symbolizer, shade):
+    """
+    Set the color of the symbolizer of a rule.
+
+    @type  rule: L{sld.Rule}
+    @param rule: The rule to color.
+    @type  symbolizer: L{sld.Symbolizer} I{class}
+    @param symbolizer: The symbolizer type of the rule.
+    @type  shade: string
+    @param shade: The color, as a '#rrggbb' string.
+    """
+    if symbolizer == PolygonSymbolizer:
+        rule.PolygonSymbolizer.Stroke.CssParameters[0].Value = '#000000'
+
+    parameter = _get_shade_parameter(rule, symbolizer)
+    if not parameter is None:
+        parameter.Value = shade
+
+def _get_shade_parameter(rule, symbolizer):
+    """
+    Get the CssParameter that holds the color of the symbolizer of a rule.
+    """
+    if symbolizer == PointSymbolizer:
+        return rule.PointSymbolizer.Graphic.Mark.Fill.CssParameters[0]
+    elif symbolizer == LineSymbolizer:
+        return rule.LineSymbolizer.Stroke.CssParameters[0]
+    elif symbolizer == PolygonSymbolizer:
+        return rule.PolygonSymbolizer.Fill.CssParameters[0]
+    return None
+
+def _upper_filter(rule, propertyname, literal):
+    """
+    Create the filter of a rule that compares a property with the upper
+    bound of its class.
+    """
+    f_high = Filter(rule)
+    f_high.PropertyIsLessThanOrEqualTo = PropertyCriterion(f_high, 'PropertyIsLessThanOrEqualTo')
+    f_high.PropertyIsLessThanOrEqualTo.PropertyName = propertyname
+    f_high.PropertyIsLessThanOrEqualTo.Literal = literal
+    return f_high
+
+def _set_scales(rule, minscale, maxscale):
+    """
+    Add the scale denominators to a rule element, after its filter.
+    """
+    namespace = rule.nsmap['sld']
+    index = len(rule)
+    for i, child in enumerate(rule):
+        if child.tag.endswith('Symbolizer'):
+            index = i
+            break
+
+    for tag, scale in (('MaxScaleDenominator', maxscale,), ('MinScaleDenominator', minscale,),):
+        if not scale is None:
+            element = Element('{%s}%s' % (namespace, tag))
+            element.text = str(scale)
+            rule.insert(index, element)
+
+def _write(xf, element, texts, tags=None, hooks=None, nsmap=None):
+    """
+    Write an element and its children to an C{lxml.etree.xmlfile}, one at a
+    time, so that only the namespaces of the root are declared. Texts are
+    replaced from texts, and tags from tags. An element in hooks is written
+    by its function instead, or skipped if its function is None.
+    """
+    if hooks and element in hooks:
+        if not hooks[element] is None:
+            hooks[element](xf)
+        return
+
+    tag = element.tag
+    if tags:
+        tag = tags.get(tag, tag)
+
+    with xf.element(tag, dict(element.attrib), nsmap=nsmap):
+        if element.text:
+            xf.write(texts.get(element.text, element.text))
+        for child in element:
+            _write(xf, child, texts, tags, hooks)
+
+def _literal(qbin):
+    """
+    Get the text of a class break.
+    """
+    if hasattr(qbin, 'shape') and len(qbin.shape) > 0:
+        qbin = qbin[0]
+    return str(qbin)
+
+def _get_skeleton(symbolizer, hastitle, hasftsname):
+    """
+    Get the compiled fragments of an SLD document, compiling them on first use.
+    """
+    key = (symbolizer.__name__, hastitle, hasftsname,)
+    if not key in _skeletons:
+        skeleton = _compile(symbolizer, hastitle, hasftsname)
+        with _skeletons_lock:
+            _skeletons[key] = skeleton
+
+    return _skeletons[key]
+
+def _compile(symbolizer, hastitle, hasftsname):
+    """
+    Render an SLD document with two classes of placeholders, and split it
+    into the fragments before, within, and after the rules.
+    """
+    thesld = render_sld('{djsld:name}', symbolizer, '{djsld:property}', 
+        ['{djsld:high}', '{djsld:high}'], ['{djsld:shade}', '{djsld:shade}'],
+        '{djsld:title}' if hastitle else None, '{djsld:ftsname}' if hasftsname else None)
+    xml = thesld.as_sld()
+
+    start = xml.index(b'<sld:Rule>')
+    second = xml.index(b'<sld:Rule>', start + 1)
+    end = xml.rindex(b'</sld:Rule>') + len(b'</sld:Rule>')
+
+    # the titles and the lower bound are derived from the upper bound
+    # placeholders when rendering, so restore them as their own placeholders
+    head = xml[:start]
+    first = xml[start:second].replace(b'&lt;= {djsld:high}', b'{djsld:rule}', 1)
+    rest = xml[second:end].replace(b'&lt;= {djsld:high}', b'{djsld:rule}', 1)
+    rest = rest.replace(b'<ogc:Literal>{djsld:high}</ogc:Literal>', 
+        b'<ogc:Literal>{djsld:low}</ogc:Literal>', 1)
+    tail = xml[end:]
+
+    return tuple(_PLACEHOLDER.split(fragment) for fragment in (head, first, rest, tail,))
+
+def _fill(chunks, fragments, values):
+    """
+    Append compiled fragments to a list of chunks, replacing the placeholder
+    names with their escaped values.
+    """
+    for i,fragment in enumerate(fragments):
+        if i % 2 == 0:
+            chunks.append(fragment)
+        else:
+            chunks.append(_escape(values[fragment.decode('ascii')]))
+
+def _escape(value):
+    """
+    Escape a value as XML text, the same way lxml serializes text to ASCII.
+    """
+    if not isinstance(value, type(u'')):
+        value = str(value)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+    value = value.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+    value = value.replace(u'>', u'&gt;').replace(u'\r', u'&#13;')
+    return value.encode('ascii', 'xmlcharrefreplace')
@@ -0,0 +1,593 @@
+"""
+Maintain quantile sketches of model fields.
+
+A quantile sketch summarizes a distribution in a small, fixed amount of
+space, and estimates its quantiles without the values themselves. This
+module implements the merging t-digest of Dunning and Ertl, which keeps
+about fifty weighted centroids by default, smallest at the tails of the
+distribution, where quantile estimates need to be most precise.
+Distributions with fewer values than that are represented exactly. Two digests can be merged into
+the digest of both distributions, so the digests of the partitions of a
+table can be combined with L{merge}.
+
+The digest of a registered model field is stored in the database, in a
+L{djsld.models.QuantileSketch}, and the value of every new instance of the
+model is added to it when the instance is saved:
+
+    from djsld import sketch
+    sketch.register(Hydrant, 'pressure')
+    sketch.rebuild(Hydrant, 'pressure')
+
+The values of new instances are collected in a digest in each process, and
+merged into the stored digest, in one transaction, once there are
+L{FLUSH_SIZE} of them, L{FLUSH_INTERVAL} seconds after the first of them, by
+a timer thread, when the digest is read, when L{flush} is called, and when
+the process exits. When an instance is changed or deleted, its previous
+value, read from the database before the change, is removed from the digest
+the same way (see L{TDigest.remove}).
+
+L{rebuild} reads every value once, and should be run after registering a
+field. Bulk changes, such as C{QuerySet.update} and C{bulk_create}, send no
+signals; call L{expire} after them, and the digest is rebuilt the next time
+it is read. The generator uses the digest of an unfiltered queryset with the
+C{sketch=True} keyword of L{djsld.generator.as_quantiles}; the breaks are
+then approximate.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+import atexit, json, logging, math, threading
+from itertools import islice
+from numpy import arange, argsort, array, asarray, concatenate, cumsum, float64, \
+    interp, unique
+from django.db import connections, transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from djsld.classifiers import Breaks
+
+FLUSH_SIZE = 1000
+"""The number of new and removed values collected in a process before they are stored."""
+
+FLUSH_INTERVAL = 60
+"""The number of seconds after which the values collected in a process are stored."""
+
+_registered = {}
+_pending = {}
+_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+class TDigest(object):
+    """
+    A merging t-digest of a distribution of values.
+    """
+
+    def __init__(self, delta=100):
+        """
+        Create an empty digest.
+
+        @type  delta: integer
+        @param delta: The compression of the digest. A digest keeps at most
+            about delta centroids, and estimates quantiles more precisely
+            with a larger delta.
+        """
+        self.delta = delta
+        """The compression of the digest."""
+
+        self.minimum = None
+        """The smallest value in the distribution."""
+
+        self.maximum = None
+        """The largest value in the distribution."""
+
+        self._means = array([], dtype=float64)
+        self._weights = array([], dtype=float64)
+        self._buffer = []
+
+    @property
+    def count(self):
+        """The number of values in the distribution."""
+        return int(self._weights.sum()) + len(self._buffer)
+
+    def add(self, value):
+        """
+        Add a value to the distribution.
+
+        @type  value: number
+        @param value: The value.
+        """
+        value = float(value)
+        self._bounds(value, value)
+        self._buffer.append(value)
+        if len(self._buffer) >= 5 * self.delta:
+            self._compress()
+
+    def update(self, values):
+        """
+        Add many values to the distribution.
+
+        @type  values: sequence
+        @param values: The values.
+        """
+        self._buffer.extend(asarray(values, dtype=float64).tolist())
+        self._compress()
+
+    def merge(self, other):
+        """
+        Add the distribution of another digest to this one.
+
+        @type  other: L{TDigest}
+        @param other: The other digest.
+        """
+        other._compress()
+        self._compress()
+        self._means = concatenate([self._means, other._means])
+        self._weights = concatenate([self._weights, other._weights])
+        self._bounds(other.minimum, other.maximum)
+        self._compress(force=True)
+
+    def remove(self, value):
+        """
+        Remove a value from the distribution. A digest does not keep the
+        values themselves, so the value is taken out of the centroid closest
+        to it, whose mean and weight are adjusted, and which is dropped when
+        it has no weight left. This is exact while each centroid holds a
+        single value, as in a small distribution, and an estimate otherwise.
+        If the value was the smallest or the largest, the closest remaining
+        centroid becomes the new minimum or maximum.
+
+        @type  value: number
+        @param value: A value that was added to the distribution.
+        """
+        value = float(value)
+        self._compress()
+        if len(self._means) == 0:
+            return
+
+        i = abs(self._means - value).argmin()
+        weight = self._weights[i]
+        if weight > 1:
+            self._means[i] = (self._means[i] * weight - value) / (weight - 1)
+            self._weights[i] = weight - 1
+        else:
+            keep = arange(len(self._means)) != i
+            self._means = self._means[keep]
+            self._weights = self._weights[keep]
+
+        if len(self._means) == 0:
+            self.minimum = self.maximum = None
+            return
+
+        # an adjusted mean may have passed its neighbors
+        self._compress(force=True)
+        if value <= self.minimum:
+            self.minimum = float(self._means[0])
+        if value >= self.maximum:
+            self.maximum = float(self._means[-1])
+
+    def quantile(self, p):
+        """
+        Estimate quantiles of the distribution. As with pysal's quantiles,
+        the quantile p is the value at the position p * (n - 1) of the n
+        sorted values, interpolated between the values around it.
+
+        @type  p: number or numpy.ndarray
+        @param p: The fractions of the distribution, from 0 to 1.
+        @rtype: number or numpy.ndarray
+        @returns: The estimated quantiles.
+        """
+        self._compress()
+        n = self._weights.sum()
+
+        # the position of the middle value of each centroid
+        centers = cumsum(self._weights) - (self._weights + 1) / 2.
+        ranks = concatenate([[0.], centers, [n - 1]])
+        values = concatenate([[self.minimum], self._means, [self.maximum]])
+
+        return interp(asarray(p) * (n - 1), ranks, values)
+
+    def dumps(self):
+        """
+        Serialize the digest.
+
+        @rtype: string
+        @returns: The digest as JSON.
+        """
+        return json.dumps({
+            'delta': self.delta,
+            'minimum': self.minimum,
+            'maximum': self.maximum,
+            'means': self._means.tolist(),
+            'weights': self._weights.tolist(),
+            'buffer': self._buffer
+        })
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Deserialize a digest.
+
+        @type  data: string
+        @param data: A digest serialized with L{dumps}.
+        @rtype: L{TDigest}
+        @returns: The digest.
+        """
+        data = json.loads(data)
+        digest = cls(data['delta'])
+        digest.minimum = data['minimum']
+        digest.maximum = data['maximum']
+        digest._means = array(data['means'], dtype=float64)
+        digest._weights = array(data['weights'], dtype=float64)
+        digest._buffer = data['buffer']
+        return digest
+
+    def _bounds(self, minimum, maximum):
+        """
+        Extend the range of the distribution.
+        """
+        if not minimum is None and (self.minimum is None or minimum < self.minimum):
+            self.minimum = minimum
+        if not maximum is None and (self.maximum is None or maximum > self.maximum):
+            self.maximum = maximum
+
+    def _compress(self, force=False):
+        """
+        Merge the buffered values into the centroids. Neighboring centroids
+        are merged as long as the merged centroid covers no more than one
+        unit of the scale function k(q) = delta / (2 pi) * asin(2q - 1).
+        """
+        if len(self._buffer) == 0 and not force:
+            return
+
+        values = array(self._buffer, dtype=float64)
+        self._buffer = []
+        if len(values) > 0:
+            self._bounds(values.min(), values.max())
+
+        means = concatenate([self._means, values])
+        weights = concatenate([self._weights, [1.] * len(values)])
+        if len(means) == 0:
+            return
+
+        order = argsort(means, kind='mergesort')
+        means = means[order].tolist()
+        weights = weights[order].tolist()
+        total = sum(weights)
+
+        newmeans, newweights = [], []
+        mean, weight = means[0], weights[0]
+        done = 0.
+        limit = self._limit(0.)
+        for m, w in zip(means[1:], weights[1:]):
+            if (done + weight + w) / total <= limit:
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                newmeans.append(mean)
+                newweights.append(weight)
+                done += weight
+                limit = self._limit(done / total)
+                mean, weight = m, w
+        newmeans.append(mean)
+        newweights.append(weight)
+
+        self._means = array(newmeans, dtype=float64)
+        self._weights = array(newweights, dtype=float64)
+
+    def _limit(self, q):
+        """
+        Get the largest quantile that a centroid starting at quantile q may
+        reach.
+        """
+        k = self.delta / (2 * math.pi) * math.asin(max(-1., min(1., 2 * q - 1))) + 1
+        if k >= self.delta / 4.:
+            return 1.
+        return (math.sin(2 * math.pi * k / self.delta) + 1) / 2.
+
+def merge(*digests):
+    """
+    Merge digests into the digest of all their distributions, such as the
+    digests of the partitions of a table.
+
+    @type  digests: L{TDigest}
+    @param digests: The digests to merge.
+    @rtype: L{TDigest}
+    @returns: A new digest.
+    """
+    merged = TDigest(max(digest.delta for digest in digests))
+    for digest in digests:
+        merged.merge(digest)
+    return merged
+
+def register(model, field):
+    """
+    Add the value of each new instance of a model to the stored digest of
+    a field, and replace or remove the previous value of each changed or
+    deleted instance. Each save or delete of an existing instance reads its
+    previous values with one more query.
+
+    @type  model: django model
+    @param model: The model class to watch.
+    @type  field: string
+    @param field: The name of the field, which may traverse related models.
+    """
+    label = _label(model)
+    _registered.setdefault(label, set()).add(field)
+
+    uid = 'djsld.sketch.%s' % label
+    pre_save.connect(_remember, sender=model, weak=False, dispatch_uid=uid)
+    post_save.connect(_update, sender=model, weak=False, dispatch_uid=uid)
+    pre_delete.connect(_remember, sender=model, weak=False, dispatch_uid=uid)
+    post_delete.connect(_remove, sender=model, weak=False, dispatch_uid=uid)
+
+def rebuild(model, field, delta=100, chunk_size=10000):
+    """
+    Build and store the digest of a field from all of its values.
+
+    @type  model: django model
+    @param model: The model class.
+    @type  field: string
+    @param field: The name of the field, which may traverse related models.
+    @type  delta: integer
+    @param delta: The compression of the digest.
+    @type  chunk_size: integer
+    @param chunk_size: The number of values read at a time.
+    @rtype: L{TDigest}
+    @returns: The digest.
+    """
+    from djsld.models import QuantileSketch
+
+    # the values collected so far are read with the others
+    with _lock:
+        _pending.pop((_label(model), field,), None)
+
+    digest = TDigest(delta)
+    queryset = model._default_manager.exclude(**{'%s__isnull' % field: True}).order_by()
+    rows = queryset.values_list(field, flat=True).iterator()
+    chunk = list(islice(rows, chunk_size))
+    while len(chunk) > 0:
+        digest.update(chunk)
+        chunk = list(islice(rows, chunk_size))
+
+    with _atomic():
+        QuantileSketch.objects.filter(model=_label(model), field=field).delete()
+        QuantileSketch.objects.create(model=_label(model), field=field, data=digest.dumps())
+
+    return digest
+
+def get_sketch(model, field):
+    """
+    Get the stored digest of a field, with the values collected in this
+    process. A digest marked stale by L{expire} is rebuilt first.
+
+    @type  model: django model
+    @param model: The model class.
+    @type  field: string
+    @param field: The name of the field.
+    @rtype: L{TDigest}
+    @returns: The digest, or None if it was never built.
+    """
+    from djsld.models import QuantileSketch
+
+    flush(model, field)
+
+    rows = list(QuantileSketch.objects.filter(model=_label(model), field=field))
+    if len(rows) == 0:
+        return None
+
+    digest = TDigest.loads(rows[0].data)
+    if rows[0].stale:
+        return rebuild(model, field, delta=digest.delta)
+    return digest
+
+def expire(model, field=None):
+    """
+    Mark the stored digests of a model stale after bulk changes, which send
+    no signals, so that they are rebuilt the next time they are read.
+
+    @type  model: django model
+    @param model: The model class.
+    @type  field: string
+    @param field: The name of the field, or None for every field.
+    """
+    from djsld.models import QuantileSketch
+
+    label = _label(model)
+    fields = list(_registered.get(label, ())) if field is None else [field]
+    with _lock:
+        for name in fields:
+            _pending.pop((label, name,), None)
+
+    QuantileSketch.objects.filter(model=label, field__in=fields).update(stale=True)
+
+def flush(model=None, field=None):
+    """
+    Store the values collected in this process in the stored digests.
+
+    @type  model: django model
+    @param model: The model class, or None for every model.
+    @type  field: string
+    @param field: The name of the field, or None for every field.
+    """
+    label = None if model is None else _label(model)
+    with _lock:
+        keys = [key for key in _pending if (label is None or key[0] == label) and 
+            (field is None or key[1] == field)]
+
+    _flush(keys)
+
+def quantiles(queryset, field, nclasses):
+    """
+    Estimate Quantile breaks from the stored digest of a field. The digest
+    describes the entire table, so it is only used for a queryset without
+    filters or slices.
+
+    @type  queryset: QuerySet
+    @param queryset: The query set that contains the entire distribution of data values.
+    @type     field: string
+    @param    field: The name of the field on the model in the queryset that contains the data values.
+    @type  nclasses: integer
+    @param nclasses: The number of class breaks desired.
+    @rtype: L{djsld.classifiers.Breaks}
+    @returns: The class breaks, or None if they cannot be estimated.
+    """
+    if queryset.query.where or not queryset.query.can_filter():
+        return None
+
+    digest = get_sketch(queryset.model, field)
+    if digest is None or digest.count == 0:
+        return None
+
+    # this mirrors pysal.esda.mapclassify.quantile
+    w = 100. / nclasses
+    p = arange(w, 100 + w, w)
+    if p[-1] > 100.0:
+        p[-1] = 100.0
+
+    return Breaks(unique(digest.quantile(p / 100.)))
+
+def _remember(sender, instance, **kwargs):
+    """
+    A signal receiver that reads the stored values of an existing instance
+    before it is saved or deleted, so that they can be removed from the
+    stored digests of its model.
+    """
+    fields = list(_registered.get(_label(sender), ()))
+    if instance.pk is None or len(fields) == 0:
+        return
+
+    rows = list(sender._default_manager.filter(pk=instance.pk).values_list(*fields))
+    instance._djsld_sketch = dict(zip(fields, rows[0])) if len(rows) > 0 else {}
+
+def _update(sender, instance, **kwargs):
+    """
+    A signal receiver that collects the values of a saved instance for the
+    stored digests of its model, in place of its previous values.
+    """
+    removed = instance.__dict__.pop('_djsld_sketch', {})
+    added = dict((field, _value(instance, field),) for field in _registered.get(_label(sender), ()))
+    _collect(sender, added, removed)
+
+def _remove(sender, instance, **kwargs):
+    """
+    A signal receiver that collects the previous values of a deleted
+    instance, to remove them from the stored digests of its model.
+    """
+    _collect(sender, {}, instance.__dict__.pop('_djsld_sketch', {}))
+
+def _collect(sender, added, removed):
+    """
+    Collect values to add to and remove from the stored digests of a model,
+    and store them once there are enough. The first values collected for a
+    digest start a timer that stores them after L{FLUSH_INTERVAL} seconds.
+    """
+    label = _label(sender)
+    full = []
+    with _lock:
+        for field in _registered.get(label, ()):
+            new, old = added.get(field), removed.get(field)
+            if new == old:
+                continue
+
+            key = (label, field,)
+            if not key in _pending:
+                # large enough to keep every value until they are stored
+                _pending[key] = (TDigest(FLUSH_SIZE), [],)
+                timer = threading.Timer(FLUSH_INTERVAL, _flush_later, (key,))
+                timer.daemon = True
+                timer.start()
+            digest, removals = _pending[key]
+            if not new is None:
+                digest.add(new)
+            if not old is None:
+                removals.append(float(old))
+            if digest.count + len(removals) >= FLUSH_SIZE:
+                full.append(key)
+
+    _flush(full)
+
+def _flush(keys):
+    """
+    Store the values collected in this process for the stored digests with
+    the given (model label, field) keys.
+    """
+    with _lock:
+        batches = [(key, _pending.pop(key),) for key in keys if key in _pending]
+    if len(batches) == 0:
+        return
+
+    from djsld.models import QuantileSketch
+
+    for (label, field), (pending, removals) in batches:
+        # lock the row, so that concurrent flushes do not lose values
+        with _atomic():
+            rows = QuantileSketch.objects.select_for_update().filter(model=label, field=field, 
+                stale=False)
+            for row in rows:
+                digest = TDigest.loads(row.data)
+                digest.merge(pending)
+                for value in removals:
+                    digest.remove(value)
+                row.data = digest.dumps()
+                row.save()
+
+def _flush_later(key):
+    """
+    Store the values collected for a stored digest, from a timer thread.
+    """
+    try:
+        _flush([key])
+    except Exception:
+        logger.exception('Could not store the values collected for the quantile sketch of %s.', key)
+    finally:
+        # connections are per thread, and this thread ends here
+        for connection in connections.all():
+            connection.close()
+
+def _value(instance, field):
+    """
+    Get the value of a field of an instance, following related models.
+    """
+    value = instance
+    for name in field.split('__'):
+        value = getattr(value, name, None)
+        if value is None:
+            return None
+    return value
+
+def _atomic():
+    """
+    Get a transaction context manager.
+    """
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic()
+    # django < 1.6
+    return transaction.commit_on_success()
+
+def _label(model):
+    """
+    Get a unique name for a model.
+    """
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+# store the values collected in this process when it exits
+atexit.register(flush)
@@ -0,0 +1,77 @@
+"""
+Measure the time it takes a new interpreter to import djsld.
+
+Each module is imported in a fresh python process, so that nothing is
+already loaded, and the fastest of several runs is reported. Run this from
+the tests directory:
+
+    python benchmark_import.py [runs]
+
+The import of djsld.generator should not load pysal, whose import time is
+reported for comparison.
+
+License
+=======
+Copyright 2011-2012 David Zwarg <U{dzwarg@azavea.com}>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+U{http://www.apache.org/licenses/LICENSE-2.0}
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+@author: David Zwarg
+@contact: dzwarg@azavea.com
+@copyright: 2011-2012, Azavea
+@license: Apache 2.0
+@version: 1.0.7
+"""
+
+import os, subprocess, sys
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+sys.stdout.write('%%f %%d' %% (time.time() - start, 'pysal' in sys.modules))
+"""
+
+def measure(module, runs=5):
+    """
+    Import a module in new interpreters.
+
+    @type  module: string
+    @param module: The name of the module to import.
+    @type  runs: integer
+    @param runs: The number of interpreters to start.
+    @rtype: tuple
+    @returns: The fastest import time in seconds, and whether pysal was
+        imported.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+    env['PYTHONPATH'] = os.pathsep.join([here, os.path.dirname(os.path.dirname(here))])
+
+    best, haspysal = None, False
+    for i in range(runs):
+        output = subprocess.Popen([sys.executable, '-c', SCRIPT % module], env=env, 
+            stdout=subprocess.PIPE).communicate()[0]
+        elapsed, loaded = output.split()
+        if best is None or float(elapsed) < best:
+            best = float(elapsed)
+        haspysal = haspysal or loaded == b'1'
+
+    return best, haspysal
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in ('djsld.generator', 'pysal.esda.mapclassify',):
+        elapsed, haspysal = measure(module, runs)
+        print('%-24s %8.3fs %s' % (module, elapsed, 'loads pysal' if haspysal else ''))
@@ -27,9 +27,16 @@ limitations under the License.
 @version: 1.0.7
 """
 
-import unittest, random
-from djsld import generator
+import unittest, random, os, subprocess, sys, threading, time
+import django
+import numpy
+from io import BytesIO
+from djsld import generator, cache, pushdown, classifiers, sketch
+from djsld.models import QuantileSketch
+from django.conf import settings
 from django.contrib.gis.geos import GEOSGeometry
+from django.db import connections
+from django.db.models import F
 from django.db.models.fields import FieldDoesNotExist
 from models import *
 
@@ -228,6 +235,75 @@ class ClassificationTest(unittest.TestCase):
         for i,n in enumerate(literals):
             self.assertEqual(n.text, expected[i], 'Class %d is not correct.' % i)
 
+    def test_fj_numpy(self):
+        """
+        Test that the NumPy Fisher Jenks classifier produces the same classes
+        as the pysal classifier.
+        """
+        cases = [
+            (Hydrant.objects.filter(pressure=2), 'number', 'location'),
+            (Pipeline.objects.filter(material='concrete'), 'diameter', 'path'),
+            (Reservoir.objects.filter(name__startswith='County'), 'volume', 'coastline')
+        ]
+        for qs, field, geofield in cases:
+            for nclasses in range(2, 8):
+                sld = generator.as_fisher_jenks(qs, field, nclasses, geofield=geofield, backend='pysal')
+                expected = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                sld = generator.as_fisher_jenks(qs, field, nclasses, geofield=geofield, backend='numpy')
+                literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                self.assertEqual(literals, expected)
+
+        # fewer distinct values than classes repeat breaks, as in pysal, and
+        # fewer values than classes have a class each
+        y = numpy.array([1, 1, 1, 2])
+        self.assertEqual(classifiers.fisher_jenks(y, 3), list(generator.Fisher_Jenks(y, 3).bins))
+        self.assertEqual(classifiers.fisher_jenks([1, 2], 3), [1, 2.0])
+        self.assertEqual(classifiers.fisher_jenks_range([1, 2], 3)[3].bins, [1, 2.0])
+
+    def test_fj_range(self):
+        """
+        Test that the breaks for a range of class counts render the same as
+        the Fisher Jenks classifier for each count.
+        """
+        qs = Reservoir.objects.filter(name__startswith='County')
+        ranges = generator.fisher_jenks_range(qs, 'volume', 7)
+
+        self.assertEqual(sorted(ranges.keys()), range(2, 8))
+
+        for nclasses in range(2, 8):
+            sld = generator.as_fisher_jenks(qs, 'volume', nclasses, geofield='coastline', backend='numpy')
+            expected = sld.as_sld()
+
+            sld = generator.render_breaks(qs, 'volume', ranges[nclasses], geofield='coastline')
+            self.assertEqual(sld.as_sld(), expected)
+
+        gvfs = [ranges[k].gvf for k in range(2, 8)]
+        self.assertEqual(gvfs, sorted(gvfs))
+
+    def test_numpy_backend(self):
+        """
+        Test that the NumPy equal interval, quantile and maximum breaks
+        classifiers produce the same classes as the pysal classifiers.
+        """
+        cases = [
+            (Hydrant.objects.filter(pressure=2), 'number', 'location'),
+            (Pipeline.objects.filter(material='concrete'), 'diameter', 'path'),
+            (Reservoir.objects.filter(name__startswith='County'), 'volume', 'coastline')
+        ]
+        classifiers = [generator.as_equal_interval, generator.as_quantiles, generator.as_maximum_breaks]
+        for qs, field, geofield in cases:
+            for classify in classifiers:
+                for nclasses in range(2, 8):
+                    sld = classify(qs, field, nclasses, geofield=geofield, backend='pysal', pushdown=False)
+                    expected = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                    sld = classify(qs, field, nclasses, geofield=geofield, backend='numpy', pushdown=False)
+                    literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                    self.assertEqual(literals, expected)
+
     def test_jc_classes_pt(self):
         """
         Test the Jenks Caspall classifier for a point-based geographic model.
@@ -441,6 +517,19 @@ class ClassificationTest(unittest.TestCase):
         # classes are still non-deterministic with the sample test data.
         self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 5)
 
+    def test_nb_numpy(self):
+        """
+        Test the NumPy Natural Breaks classifier.
+        """
+        sld = generator.as_natural_breaks(Hydrant.objects.filter(pressure=1), 'number', 5, geofield='location', backend='numpy')
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 5)
+
+        literals = sld._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal',namespaces=sld._nsmap)
+        expected = ['0', '1', '2', '3', '4']
+
+        for i,n in enumerate(literals):
+            self.assertEqual(n.text, expected[i], 'Class %d is not correct.' % i)
+
     def test_q_classes_pt(self):
         """
         Test the Quantiles classifier for a point-based geographic model.
@@ -489,6 +578,710 @@ class ClassificationTest(unittest.TestCase):
         for i,n in enumerate(literals):
             self.assertEqual(n.text, expected[i], 'Class %d is not correct.' % i)
 
+    def test_pushdown(self):
+        """
+        Test that class breaks computed in the database match the class breaks
+        computed from the entire distribution.
+        """
+        methods = [generator.as_equal_interval, generator.as_quantiles, generator.as_maximum_breaks]
+        for method in methods:
+            sld = method(Hydrant.objects.filter(pressure=2), 'number', 5, geofield='location', pushdown=True)
+            pushed = sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)
+
+            sld = method(Hydrant.objects.filter(pressure=2), 'number', 5, geofield='location', pushdown=False)
+            pulled = sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)
+
+            self.assertEqual([n.text for n in pushed], [n.text for n in pulled], 
+                'Classes computed in the database for %s are not correct.' % method.__name__)
+
+    def test_cache(self):
+        """
+        Test that cached class breaks are reused, and invalidated when the
+        model changes.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        cache.reset_stats()
+
+        sld = generator.as_fisher_jenks(qs, 'number', 5, geofield='location', cache=True)
+        expected = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        sld = generator.as_fisher_jenks(qs, 'number', 5, geofield='location', cache=True)
+        literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+        self.assertEqual(literals, expected)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # a different number of classes is a different cache entry
+        generator.as_fisher_jenks(qs, 'number', 4, geofield='location', cache=True)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        h = Hydrant.objects.get(number=2401)
+        h.save()
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+        generator.as_fisher_jenks(qs, 'number', 5, geofield='location', cache=True)
+        self.assertEqual(cache.stats()['misses'], 3)
+
+        # a change to a model that the filters traverse invalidates the breaks
+        qs = Hydrant.objects.filter(pipeline__reservoir__name__startswith='County')
+        generator.as_quantiles(qs, 'number', 5, geofield='location', cache=True)
+        generator.as_quantiles(qs, 'number', 5, geofield='location', cache=True)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+        r = Reservoir.objects.get(name='County 0')
+        r.save()
+        generator.as_quantiles(qs, 'number', 5, geofield='location', cache=True)
+        self.assertEqual(cache.stats()['misses'], 5)
+
+    def test_cache_single_flight(self):
+        """
+        Test that concurrent requests for missing class breaks compute them
+        once, and that stale breaks are served while another process computes
+        them.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        calls = []
+        def classify():
+            calls.append(1)
+            time.sleep(0.2)
+            return classifiers.Breaks([2, 4])
+
+        results = []
+        def request():
+            results.append(cache.get_or_classify('Single_Flight', qs, 'number', 2, classify))
+        threads = [threading.Thread(target=request) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([q.bins for q in results], [results[0].bins] * 5)
+
+        # another process holds the lock on the new breaks after a change
+        cache.invalidate(Hydrant)
+        key = cache.make_key('Single_Flight', qs, 'number', 2, [Hydrant])
+        cache.get_backend().add('%s:lock' % key, 'another process', 60)
+
+        q = cache.get_or_classify('Single_Flight', qs, 'number', 2, classify)
+        self.assertEqual(q.bins, results[0].bins)
+        self.assertEqual(len(calls), 1)
+
+        cache.get_backend().delete('%s:lock' % key)
+
+        # a slow classification does not block the breaks of other keys
+        release = threading.Event()
+        def slow():
+            release.wait(5)
+            return classifiers.Breaks([1, 4])
+        thread = threading.Thread(target=cache.get_or_classify, args=('Single_Flight', qs, 'number', 3, slow))
+        thread.start()
+        try:
+            q = cache.get_or_classify('Single_Flight', qs, 'number', 4, lambda: classifiers.Breaks([1, 2, 4]))
+            self.assertEqual(q.bins, [1, 2, 4])
+            self.assertTrue(thread.is_alive())
+        finally:
+            release.set()
+            thread.join()
+
+    def test_cache_background(self):
+        """
+        Test that stale class breaks are served at once, while new breaks are
+        computed in the background.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        q = cache.get_or_classify('Background', qs, 'number', 2, 
+            lambda: classifiers.Breaks([1, 2]), background=True)
+        self.assertEqual(q.bins, [1, 2])
+        self.assertTrue(cache.last_age() < 1)
+
+        refreshed = threading.Event()
+        def classify():
+            refreshed.set()
+            return classifiers.Breaks([3, 4])
+
+        cache.invalidate(Hydrant)
+        q = cache.get_or_classify('Background', qs, 'number', 2, classify, background=True)
+        self.assertEqual(q.bins, [1, 2])
+        self.assertTrue(refreshed.wait(5))
+
+        for i in range(50):
+            q = cache.get_or_classify('Background', qs, 'number', 2, classify, background=True)
+            if q.bins == [3, 4]:
+                break
+            time.sleep(0.1)
+        self.assertEqual(q.bins, [3, 4])
+
+    def test_cache_fingerprint(self):
+        """
+        Test that class breaks kept by fingerprint are recomputed after a
+        bulk update, which sends no signals.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        fingerprint = cache.get_fingerprint(qs, 'number')
+        self.assertEqual(cache.get_fingerprint(qs, 'number'), fingerprint)
+
+        cache.reset_stats()
+        classify = lambda: classifiers.Breaks([1, 2])
+        cache.get_or_classify('Fingerprint', qs, 'number', 2, classify, fingerprint=True)
+        cache.get_or_classify('Fingerprint', qs, 'number', 2, classify, fingerprint=True)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        Hydrant.objects.filter(number=2401).update(number=2402)
+        try:
+            self.assertNotEqual(cache.get_fingerprint(qs, 'number'), fingerprint)
+
+            cache.get_or_classify('Fingerprint', qs, 'number', 2, classify, fingerprint=True)
+            self.assertEqual(cache.stats()['misses'], 2)
+        finally:
+            Hydrant.objects.filter(number=2402).update(number=2401)
+
+    def test_cache_replica_lag(self):
+        """
+        Test that class breaks computed just after an invalidation expire
+        once a replica would have the change.
+        """
+        qs = Hydrant.objects.filter(pressure=1)
+        classify = lambda: classifiers.Breaks([1, 2])
+        settings.DJSLD_CACHE_REPLICA_LAG = 1
+        try:
+            cache.invalidate(Hydrant)
+            cache.reset_stats()
+            cache.get_or_classify('Replica_Lag', qs, 'number', 2, classify)
+            cache.get_or_classify('Replica_Lag', qs, 'number', 2, classify)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+            time.sleep(2)
+            cache.get_or_classify('Replica_Lag', qs, 'number', 2, classify)
+            cache.get_or_classify('Replica_Lag', qs, 'number', 2, classify)
+            self.assertEqual(cache.stats()['misses'], 2)
+        finally:
+            del settings.DJSLD_CACHE_REPLICA_LAG
+
+    def test_compress(self):
+        """
+        Test that classes computed from distinct values and their counts match
+        the classes computed from the entire distribution.
+        """
+        methods = [generator.as_equal_interval, generator.as_fisher_jenks, 
+            generator.as_maximum_breaks, generator.as_quantiles]
+        for method in methods:
+            for field in ['number', 'pipeline__diameter']:
+                sld = method(Hydrant.objects.all(), field, 3, geofield='location', pushdown=False)
+                expected = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                sld = method(Hydrant.objects.all(), field, 3, geofield='location', pushdown=False, compress=True)
+                literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+                self.assertEqual(literals, expected, 
+                    'Compressed classes for %s on "%s" are not correct.' % (method.__name__, field,))
+
+        # the weighted classes are as good as the classes of the repeated values
+        rng = numpy.random.RandomState(0)
+        y = numpy.unique(rng.randint(0, 1000, 200))
+        weights = rng.randint(1, 20, len(y))
+        weighted = classifiers.weighted_fisher_jenks_range(y, weights, 9)
+        repeated = classifiers.fisher_jenks_range(numpy.repeat(y, weights), 9)
+        for k in range(2, 10):
+            self.assertAlmostEqual(weighted[k].gvf, repeated[k].gvf)
+
+    def test_histogram(self):
+        """
+        Test the classification of a histogram of the distribution.
+        """
+        hist = pushdown.histogram(Hydrant.objects.filter(pressure=2), 'number', 100)
+        self.assertEqual(hist.counts.sum(), 50)
+        self.assertAlmostEqual(hist.width, 24.01)
+        self.assertAlmostEqual(hist.error, 12.005)
+        self.assertEqual(hist.maximum, 2401)
+
+        methods = [generator.as_fisher_jenks, generator.as_jenks_caspall, generator.as_quantiles]
+        for method in methods:
+            sld = method(Hydrant.objects.filter(pressure=2), 'number', 5, geofield='location', 
+                pushdown=False, histogram=1000)
+            self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 5)
+
+            literals = sld._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal',namespaces=sld._nsmap)
+            self.assertEqual(literals[-1].text, '2401')
+
+        # the breaks are bin centers, except for the maximum value
+        sld = generator.as_fisher_jenks(Hydrant.objects.filter(pressure=1), 'number', 2, geofield='location',
+            histogram=4)
+        literals = sld._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal',namespaces=sld._nsmap)
+        self.assertEqual([n.text for n in literals], ['1.5', '4'])
+
+        # Fisher-Jenks on many bins takes O(k m log m) time, not O(k m^2)
+        centers = numpy.arange(20000) + 0.5
+        counts = numpy.random.RandomState(0).randint(1, 100, len(centers))
+        started = time.time()
+        q = classifiers.classify_weighted(generator.Fisher_Jenks, centers, counts, 9, exact=False)
+        self.assertEqual(len(q.bins), 9)
+        self.assertTrue(time.time() - started < 10, 'Fisher-Jenks on 20000 bins took too long.')
+
+    def test_sample(self):
+        """
+        Test the classification of a random sample of the distribution.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        sld = generator.as_fisher_jenks(qs, 'number', 5, geofield='location', sample=20, seed=42)
+        first = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+        # the top class always contains the largest value
+        literals = sld._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal',namespaces=sld._nsmap)
+        self.assertEqual(literals[-1].text, '2401')
+
+        # the same seed produces the same sample
+        sld = generator.as_fisher_jenks(qs, 'number', 5, geofield='location', sample=20, seed=42)
+        second = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+        self.assertEqual(first, second)
+
+        # a sample larger than the distribution classifies every value
+        sld = generator.as_fisher_jenks(qs, 'number', 5, geofield='location', sample=1000)
+        literals = sld._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal',namespaces=sld._nsmap)
+        expected = ['324', '784', '1296', '1849', '2401.0']
+
+        for i,n in enumerate(literals):
+            self.assertEqual(n.text, expected[i], 'Class %d is not correct.' % i)
+
+        # a sample of one value in fifty is often empty in the database
+        for seed in range(20):
+            values, maximum = generator._extract_sample(qs, 'number', 1, seed)
+            self.assertTrue(len(values) > 0)
+            self.assertEqual(maximum, 2401)
+
+        # the sample of the whole table keeps the filters of a queryset with joins
+        if pushdown._pg_version(qs) >= 90500:
+            qs = Hydrant.objects.filter(pipeline__reservoir__name__startswith='County', 
+                pipeline__reservoir__pipeline__material='concrete')
+            sampled = generator._tablesample(qs, 100, 0)
+            self.assertEqual(sorted(sampled.values_list('number', flat=True)), 
+                sorted(qs.values_list('number', flat=True)))
+
+    def test_asxml(self):
+        """
+        Test that SLD XML rendered from precompiled fragments is the same as
+        the serialized SLD object.
+        """
+        cases = [
+            (Hydrant.objects.filter(pressure=2), 'number', 'location'),
+            (Pipeline.objects.filter(material='concrete'), 'diameter', 'path'),
+            (Reservoir.objects.filter(name__startswith='County'), 'volume', 'coastline')
+        ]
+        for qs, field, geofield in cases:
+            sld = generator.as_quantiles(qs, field, 5, geofield=geofield, 
+                userstyletitle='Quantiles & more', featuretypestylename='fts')
+            xml = generator.as_quantiles(qs, field, 5, geofield=geofield, 
+                userstyletitle='Quantiles & more', featuretypestylename='fts', asxml=True)
+
+            self.assertEqual(xml, sld.as_sld())
+
+    def test_categorize(self):
+        """
+        Test that the categorize layout colors a single rule with the
+        thresholds and colors of the rules of the default layout, and
+        filters it on the largest break.
+        """
+        qs = Reservoir.objects.filter(name__startswith='County')
+        rules = generator.as_quantiles(qs, 'volume', 5, geofield='coastline')
+        sld = generator.as_quantiles(qs, 'volume', 5, geofield='coastline', layout='categorize')
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 1)
+
+        highs = rules._node.xpath('//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal/text()', namespaces=rules._nsmap)
+
+        # the rule leaves out the features above the largest break
+        literals = sld._node.xpath('//ogc:Filter/ogc:PropertyIsLessThanOrEqualTo/ogc:Literal/text()', namespaces=sld._nsmap)
+        self.assertEqual(literals, highs[-1:])
+        fills = rules._node.xpath('//sld:Fill/sld:CssParameter/text()', namespaces=rules._nsmap)
+        expected = [fills[0]]
+        for high, fill in zip(highs[:-1], fills[1:]):
+            expected.extend([high, fill])
+
+        function = sld._node.xpath('//sld:Fill/sld:CssParameter/ogc:Function', namespaces=sld._nsmap)[0]
+        self.assertEqual(function.get('name'), 'Categorize')
+        self.assertEqual(function.xpath('ogc:PropertyName/text()', namespaces=sld._nsmap), ['volume'])
+        self.assertEqual(function.xpath('ogc:Literal/text()', namespaces=sld._nsmap), expected + ['preceding'])
+
+        xml = generator.as_quantiles(qs, 'volume', 5, geofield='coastline', layout='categorize', asxml=True)
+        self.assertEqual(xml, sld.as_sld())
+
+    def test_first_match(self):
+        """
+        Test that the first match layout compares each class with its upper
+        bound only, and draws the same features in the same classes as the
+        default layout, including values above the largest break and NULL
+        values, which neither draws.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        rules = generator.as_quantiles(qs, 'number', 5, geofield='location')
+        sld = generator.as_quantiles(qs, 'number', 5, geofield='location', layout='first')
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 5)
+
+        path = '//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal/text()'
+        highs = rules._node.xpath(path, namespaces=rules._nsmap)
+        self.assertEqual(sld._node.xpath(path, namespaces=sld._nsmap), highs)
+        self.assertEqual(len(sld._node.xpath('//ogc:PropertyIsGreaterThan', namespaces=sld._nsmap)), 0)
+        self.assertEqual(len(sld._node.xpath('//sld:ElseFilter', namespaces=sld._nsmap)), 0)
+
+        option = sld._node.xpath('//sld:FeatureTypeStyle/sld:VendorOption', namespaces=sld._nsmap)[0]
+        self.assertEqual((option.get('name'), option.text), ('ruleEvaluation', 'first'))
+
+        def classes(thesld, value):
+            # the indexes of the rules that draw a value; comparisons with NULL are false
+            matched = []
+            for i, rule in enumerate(thesld._node.xpath('//sld:Rule', namespaces=thesld._nsmap)):
+                lows = rule.xpath('.//ogc:PropertyIsGreaterThan/ogc:Literal/text()', namespaces=thesld._nsmap)
+                highs = rule.xpath('.//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal/text()', namespaces=thesld._nsmap)
+                if not value is None and all(value > float(low) for low in lows) and \
+                    all(value <= float(high) for high in highs):
+                    matched.append(i)
+            return matched
+
+        numbers = list(qs.values_list('number', flat=True))
+        for value in numbers + [min(numbers) - 1, max(numbers) + 1, None]:
+            expected = classes(rules, value)
+            self.assertEqual(classes(sld, value)[:1], expected)
+        self.assertEqual(classes(sld, max(numbers) + 1), [])
+        self.assertEqual(classes(sld, None), [])
+
+    def test_scales(self):
+        """
+        Test that each band of scales has the rules of its own number of
+        classes, limited to its scale denominators.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        sld = generator.as_quantiles(qs, 'number', 5, geofield='location', 
+            scales=[(100000, 3), (1000000, 1)])
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 9)
+
+        rules = sld._node.xpath('//sld:Rule', namespaces=sld._nsmap)
+        scales = [(rule.xpath('sld:MinScaleDenominator/text()', namespaces=sld._nsmap),
+            rule.xpath('sld:MaxScaleDenominator/text()', namespaces=sld._nsmap)) for rule in rules]
+        self.assertEqual(scales, [([], ['100000'])] * 5 + [(['100000'], ['1000000'])] * 3 + [(['1000000'], [])])
+
+        path = '//ogc:PropertyIsLessThanOrEqualTo/ogc:Literal/text()'
+        expected = generator.as_quantiles(qs, 'number', 3, geofield='location')
+        literals = [rule.xpath('.' + path, namespaces=sld._nsmap) for rule in rules[5:8]]
+        self.assertEqual(sum(literals, []), expected._node.xpath(path, namespaces=expected._nsmap))
+
+        # the cache and extraction options apply to every band
+        cache.invalidate(Hydrant)
+        cache.reset_stats()
+        for i in range(2):
+            compressed = generator.as_quantiles(qs, 'number', 5, geofield='location', 
+                scales=[(100000, 3), (1000000, 1)], compress=True, cache=True)
+            self.assertEqual(compressed.as_sld(), sld.as_sld())
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_unique_values(self):
+        """
+        Test that each distinct value of a field has a rule, or a pair of
+        Recode arguments, and that the streamed XML is the same as the SLD.
+        """
+        qs = Pipeline.objects.all()
+        sld = generator.as_unique_values(qs, 'material', geofield='path')
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 2)
+        literals = sld._node.xpath('//ogc:PropertyIsEqualTo/ogc:Literal/text()', namespaces=sld._nsmap)
+        self.assertEqual(literals, ['ceramic', 'concrete'])
+
+        self.assertEqual(generator.as_unique_values(qs, 'material', geofield='path', asxml=True), sld.as_sld())
+        output = generator.as_unique_values(qs, 'material', geofield='path', output=BytesIO())
+        self.assertEqual(output.getvalue(), sld.as_sld())
+
+        sld = generator.as_unique_values(qs, 'material', geofield='path', layout='recode', bycount=True)
+        self.assertEqual(len(sld.NamedLayer.UserStyle.FeatureTypeStyle.Rules), 1)
+        function = sld._node.xpath('//sld:CssParameter/ogc:Function', namespaces=sld._nsmap)[0]
+        self.assertEqual(function.get('name'), 'Recode')
+        self.assertEqual(function.xpath('ogc:Literal/text()', namespaces=sld._nsmap)[0::2], ['concrete', 'ceramic'])
+
+    def test_iterate(self):
+        """
+        Test that rows read in chunks, through a server-side cursor on
+        PostgreSQL, are the rows of the queryset.
+        """
+        qs = Hydrant.objects.order_by().values_list('number', 'pressure')
+        rows = list(generator._iterate(qs, chunk_size=7))
+        self.assertEqual(sorted(rows), sorted(qs))
+        self.assertEqual(list(generator._iterate(Hydrant.objects.none().values_list('number'))), [])
+
+        # the values are converted by django, as the queryset's are
+        if django.VERSION >= (1, 11):
+            from django.contrib.gis.db.models.functions import Length
+            qs = Pipeline.objects.annotate(length=Length('path')).order_by().values_list('length', flat=True)
+            rows = [row[0] for row in generator._iterate(qs.values_list('length'), chunk_size=7)]
+            self.assertEqual(sorted(row.m for row in rows), sorted(length.m for length in qs))
+
+    def test_multiple_fields(self):
+        """
+        Test that classifying several fields at once produces the same SLD as
+        classifying each field.
+        """
+        qs = Hydrant.objects.filter(pressure__gt=1)
+        fields = ['number', 'pressure']
+        expected = [generator.as_quantiles(qs, field, 3, geofield='location', pushdown=False).as_sld() for field in fields]
+
+        slds = generator.as_quantiles(qs, fields, 3, geofield='location', threads=2)
+        self.assertEqual(sorted(slds.keys()), fields)
+        self.assertEqual([slds[field].as_sld() for field in fields], expected)
+
+        slds = generator.as_quantiles(qs, fields, 3, geofield='location', compress=True, cache=True)
+        self.assertEqual([slds[field].as_sld() for field in fields], expected)
+
+        sld = generator.as_quantiles(qs, fields, 3, geofield='location', layers=True)
+        names = sld._node.xpath('sld:NamedLayer/sld:Name', namespaces=sld._nsmap)
+        self.assertEqual([name.text for name in names], ['3 breaks on "%s" as Quantiles' % field for field in fields])
+
+    def test_lazy_import(self):
+        """
+        Test that importing the generator does not import pysal, and that the
+        registered classifiers import it when used.
+        """
+        code = 'import sys, djsld.generator; sys.exit("pysal" in sys.modules)'
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], env=env), 0)
+
+        for name, classifier in generator.CLASSIFIERS.items():
+            self.assertEqual(classifier.load().__name__, classifier.__name__)
+
+    def test_sketch(self):
+        """
+        Test quantiles estimated from a quantile sketch, which is exact for
+        small distributions, and updated when instances are created, changed
+        or deleted.
+        """
+        sketch.register(Reservoir, 'volume')
+        digest = sketch.rebuild(Reservoir, 'volume', delta=1000)
+        self.assertEqual(digest.count, 55)
+
+        try:
+            qs = Reservoir.objects.all()
+            sld = generator.as_quantiles(qs, 'volume', 5, geofield='coastline', pushdown=False)
+            expected = [float(n.text) for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+            sld = generator.as_quantiles(qs, 'volume', 5, geofield='coastline', sketch=True)
+            literals = [float(n.text) for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+            self.assertEqual(len(literals), len(expected))
+            for literal, value in zip(literals, expected):
+                self.assertAlmostEqual(literal, value)
+
+            # the sketch describes the whole table
+            self.assertEqual(sketch.quantiles(qs.filter(name__startswith='County'), 'volume', 5), None)
+
+            r = Reservoir(name='Lake', volume=1, coastline=GEOSGeometry('POLYGON((0 0, 1 0, 0 1, 0 0))'))
+            r.save()
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').count, 56)
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').minimum, 1)
+
+            merged = sketch.merge(digest, sketch.get_sketch(Reservoir, 'volume'))
+            self.assertEqual(merged.count, 111)
+
+            # a changed value is replaced, and a deleted one removed
+            r.volume = 2
+            r.save()
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').count, 56)
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').minimum, 2)
+
+            r.delete()
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').count, 55)
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').minimum, 10000)
+
+            sld = generator.as_quantiles(qs, 'volume', 5, geofield='coastline', sketch=True)
+            literals = [float(n.text) for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+            self.assertEqual(len(literals), len(expected))
+            for literal, value in zip(literals, expected):
+                self.assertAlmostEqual(literal, value)
+
+            # the values are stored by a timer, without reading the sketch
+            interval = sketch.FLUSH_INTERVAL
+            sketch.FLUSH_INTERVAL = 0.1
+            try:
+                r = Reservoir(name='Lake', volume=1, coastline=GEOSGeometry('POLYGON((0 0, 1 0, 0 1, 0 0))'))
+                r.save()
+                time.sleep(1)
+                row = QuantileSketch.objects.get(model='%s.Reservoir' % Reservoir._meta.app_label, 
+                    field='volume')
+                self.assertEqual(sketch.TDigest.loads(row.data).count, 56)
+            finally:
+                sketch.FLUSH_INTERVAL = interval
+                r.delete()
+
+            # bulk changes send no signals, so the sketch is rebuilt when read
+            Reservoir.objects.filter(name='City 0').update(volume=5)
+            sketch.expire(Reservoir)
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').minimum, 5)
+            self.assertFalse(QuantileSketch.objects.get(field='volume').stale)
+            Reservoir.objects.filter(name='City 0').update(volume=10000)
+
+            self.assertEqual(sketch.rebuild(Reservoir, 'volume', delta=1000).count, 55)
+            self.assertEqual(sketch.get_sketch(Reservoir, 'volume').count, 55)
+        finally:
+            QuantileSketch.objects.all().delete()
+
+    def test_partitions(self):
+        """
+        Test that values fetched from partitions concurrently produce the same
+        classes as the entire queryset.
+        """
+        qs = Hydrant.objects.all()
+        partitions = [qs.filter(pressure=1), qs.filter(pressure=2)]
+        for method in [generator.as_fisher_jenks, generator.as_quantiles]:
+            sld = method(qs, 'number', 5, geofield='location', pushdown=False)
+            expected = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+            for compress in [False, True]:
+                sld = method(qs, 'number', 5, geofield='location', partitions=partitions, compress=compress)
+                literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+                self.assertEqual(literals, expected)
+
+            sld = method(qs, 'number', 5, geofield='location', partitions=['default'])
+            literals = [n.text for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+            self.assertEqual(literals, expected)
+
+    def test_using(self):
+        """
+        Test that the values are read from the requested database.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        expected = generator.as_quantiles(qs, 'number', 5, geofield='location').as_sld()
+        sld = generator.as_quantiles(qs, 'number', 5, geofield='location', using='default')
+        self.assertEqual(sld.as_sld(), expected)
+
+        self.assertEqual(generator._route(qs, 'replica').db, 'replica')
+        self.assertEqual(generator._route(qs.using('replica')).db, 'replica')
+        self.assertEqual(generator._route(qs.using('replica'), 'default').db, 'default')
+
+    def test_groupby(self):
+        """
+        Test that classifying groups produces the same SLD as classifying
+        each group, whether the breaks are computed in the database or from
+        the values of every group.
+        """
+        qs = Hydrant.objects.all()
+        for pushdown in (True, False,):
+            for classify in (generator.as_quantiles, generator.as_equal_interval,):
+                slds = classify(qs, 'number', 3, geofield='location', groupby='pressure', 
+                    pushdown=pushdown, threads=2)
+                self.assertEqual(sorted(slds.keys()), [1, 2])
+
+                for pressure in (1, 2,):
+                    expected = classify(qs.filter(pressure=pressure), 'number', 3, geofield='location')
+                    self.assertEqual(slds[pressure].as_sld(), expected.as_sld())
+
+        slds = generator.as_quantiles(Pipeline.objects.all(), 'diameter', 1, geofield='path', groupby='material')
+        self.assertEqual(sorted(slds.keys()), ['ceramic', 'concrete'])
+
+        # cached groups are not computed again
+        cache.invalidate(Hydrant)
+        cache.reset_stats()
+        slds = generator.as_quantiles(qs, 'number', 3, geofield='location', groupby='pressure', cache=True)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        cached = generator.as_quantiles(qs, 'number', 3, geofield='location', groupby='pressure', cache=True)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hits'], 2)
+        for pressure in (1, 2,):
+            self.assertEqual(cached[pressure].as_sld(), slds[pressure].as_sld())
+
+    def test_classify_values(self):
+        """
+        Test that classifying values in memory, or from a cursor, produces
+        the same SLD as classifying the queryset.
+        """
+        qs = Hydrant.objects.filter(pressure=2)
+        expected = generator.as_quantiles(qs, 'number', 5, geofield='location').as_sld()
+
+        values = numpy.array(sorted(qs.values_list('number', flat=True)))
+        sld = generator.classify_values(generator.Quantiles, values, 5, 'number')
+        self.assertEqual(sld.as_sld(), expected)
+
+        sld = generator.classify_values('Quantiles', memoryview(values[::-1].copy()), 5, 'number')
+        self.assertEqual(sld.as_sld(), expected)
+
+        cursor = connections['default'].cursor()
+        cursor.execute('SELECT number FROM %s WHERE pressure = 2' % Hydrant._meta.db_table)
+        sld = generator.classify_values(generator.Quantiles, cursor, 5, 'number', geometry='Point')
+        self.assertEqual(sld.as_sld(), expected)
+
+        sld = generator.classify_values(generator.Quantiles, values, 5, 'number', geometry='MultiPolygon')
+        self.assertEqual(len(sld._node.xpath('//sld:PolygonSymbolizer', namespaces=sld._nsmap)), 5)
+
+    def test_mixed_values(self):
+        """
+        Test that values that mix integers and floats are read as floats,
+        and that NULL values are skipped, in sequences and cursors.
+        """
+        values = generator._as_values([1, 2.5, None, 7])
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertEqual(list(values), [1.0, 2.5, 7.0])
+
+        values = generator._as_values(numpy.array([None, 3, 1], dtype=object))
+        self.assertEqual(values.dtype, numpy.int64)
+        self.assertEqual(list(values), [1, 3])
+
+        class Cursor(object):
+            rowcount = -1
+            def __init__(self, rows):
+                self.rows = list(rows)
+            def fetchmany(self, size):
+                chunk, self.rows = self.rows[:size], self.rows[size:]
+                return chunk
+
+        values = generator._as_values(Cursor([(1,), (2.5,), (None,)]))
+        self.assertEqual(list(values), [1.0, 2.5])
+
+        # one row at a time, so the float is read after the integers
+        values = generator._as_values(Cursor([(7,), (1,), (None,), (2.5,)]), chunk_size=1)
+        self.assertEqual(values.dtype, numpy.float64)
+        self.assertEqual(list(values), [1.0, 2.5, 7.0])
+
+    def test_expression(self):
+        """
+        Test that an expression is classified in the database, and filtered
+        by its propertyname.
+        """
+        qs = Pipeline.objects.all()
+        values = numpy.array(sorted(2 * d for d in qs.values_list('diameter', flat=True)))
+        expected = generator.classify_values(generator.Quantiles, values, 5, 'double_diameter', 
+            geometry='LineString').as_sld()
+
+        for pushdown in (True, False,):
+            sld = generator.as_quantiles(qs, F('diameter') * 2, 5, geofield='path', 
+                propertyname='double_diameter', pushdown=pushdown)
+            self.assertEqual(sld.as_sld(), expected)
+
+        try:
+            generator.as_quantiles(qs, F('diameter') * 2, 5, geofield='path')
+            self.fail('An expression without a propertyname was classified.')
+        except ValueError, e:
+            pass
+
+    def test_measure_expression(self):
+        """
+        Test that measures, and expressions that mix measures with fields,
+        are classified as floats.
+        """
+        from django.contrib.gis.db.models.functions import Area, Length
+
+        cases = [
+            (Pipeline.objects.all(), F('diameter') * Length('path'), 'path', 'LineString',
+                [p.diameter * p.length.m for p in Pipeline.objects.annotate(length=Length('path'))]),
+            (Reservoir.objects.all(), Area('coastline'), 'coastline', 'Polygon',
+                [r.area.sq_m for r in Reservoir.objects.annotate(area=Area('coastline'))])
+        ]
+        for qs, expression, geofield, geometry, values in cases:
+            expected = generator.classify_values(generator.Equal_Interval, numpy.array(sorted(values)), 
+                3, 'measure', geometry=geometry)
+            expected = [float(n.text) for n in expected._node.xpath('//ogc:Literal',namespaces=expected._nsmap)]
+
+            sld = generator.as_equal_interval(qs, expression, 3, geofield=geofield, 
+                propertyname='measure', pushdown=False)
+            literals = [float(n.text) for n in sld._node.xpath('//ogc:Literal',namespaces=sld._nsmap)]
+
+            self.assertEqual(len(literals), len(expected))
+            for literal, value in zip(literals, expected):
+                self.assertAlmostEqual(literal, value)
+
     def test_related_fields(self):
         """
         Test the queryset and style generation using django related fields
@@ -68,7 +68,7 @@ setup(
     keywords = "ogc sld geo geoserver mapserver osgeo geodjango",
     url = "http://github.com/azavea/django-sld/",
     requires = ["python_sld", "pysal", "scipy", "numpy", "colorbrewer"],
-    packages = ["djsld","djsld.tests","djsld.tests.djsld-test"],
+    packages = ["djsld","djsld.migrations","djsld.tests","djsld.tests.djsld-test"],
     long_description = read('README.markdown'),
     cmdclass={'test': RunTests},
     classifiers=[